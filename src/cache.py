@@ -0,0 +1,148 @@
+import collections
+import os.path
+import pickle
+import time
+
+import trees
+import util
+
+
+def replace_words(tree, words):
+    '''
+    :return: a copy of the treebank tree with its leaves carrying words, in order
+    '''
+    words = iter(words)
+
+    def helper(node):
+        if isinstance(node, trees.LeafTreebankNode):
+            return trees.LeafTreebankNode(node.tag, next(words))
+        return trees.InternalTreebankNode(node.label, [helper(child) for child in node.children])
+
+    replaced = helper(tree)
+    replaced.degraded = tree.degraded
+    return replaced
+
+
+class ParseCache(object):
+    '''
+    Bounded LRU cache of parse results keyed by the token sequence of an address. When the parser normalises
+    digits (normal=1, as util.read_chunks), so does the key, and addresses that only differ in their digits
+    share one entry.
+    '''
+
+    def __init__(self, max_size=100000, ttl=None, path=None, normal=1):
+        '''
+        :param ttl: seconds an entry stays valid, None to keep entries until they are evicted
+        :param path: pickle file the cache is loaded from if it exists and saved to by save()
+        :param normal: the normal of the parser, 1 if it only sees the normalised tokens
+        '''
+        self.max_size = max_size
+        self.normal = normal
+        self.ttl = ttl
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def key(self, tokens):
+        if self.normal == 1:
+            return tuple(util.normalize_word(token) for token in tokens)
+        return tuple(tokens)
+
+    def get(self, tokens):
+        '''
+        :return: (tree, chunks) for tokens, with the words of tokens in the tree leaves and chunk texts, or None
+        '''
+        key = self.key(tokens)
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+            del self.entries[key]
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        _, tree, chunks = entry
+        tree = replace_words(tree, tokens)
+        chunks = [(label, s, e, list(tokens[s:e])) for label, s, e, _ in chunks]
+        return tree, chunks
+
+    def put(self, tokens, tree, chunks):
+        key = self.key(tokens)
+        self.entries[key] = (time.time(), tree, chunks)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return collections.OrderedDict([
+            ("size", len(self.entries)),
+            ("hits", self.hits),
+            ("misses", self.misses),
+            ("hit_rate", self.hits / lookups if lookups else 0.0),
+            ("evictions", self.evictions),
+            ("expirations", self.expirations),
+        ])
+
+    def save(self, path=None):
+        path = path or self.path
+        with open(path, "wb") as f:
+            pickle.dump(list(self.entries.items()), f)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            entries = pickle.load(f)
+        now = time.time()
+        for key, entry in entries[-self.max_size:]:
+            if self.ttl is None or now - entry[0] <= self.ttl:
+                self.entries[key] = entry
+
+
+class CachedParser(object):
+    '''
+    Puts a ParseCache in front of a function parsing lists of token sequences.
+    '''
+
+    def __init__(self, parse_sentences, cache):
+        '''
+        :param parse_sentences: function from a list of token lists to their treebank trees
+        '''
+        self.parse_sentences = parse_sentences
+        self.cache = cache
+
+    def parse(self, addresses):
+        '''
+        :param addresses: list of token lists
+        :return: [(tree, chunks)] in the order of addresses
+        '''
+        results = [self.cache.get(tokens) for tokens in addresses]
+
+        # Every distinct missing key is parsed once, from the tokens of its first address: the parser normalises
+        # them itself if the key does.
+        missing = collections.OrderedDict()
+        for index, result in enumerate(results):
+            if result is None:
+                missing.setdefault(self.cache.key(addresses[index]), []).append(index)
+
+        if missing:
+            keys = list(missing)
+            first_addresses = [addresses[missing[key][0]] for key in keys]
+            for key, tokens, tree in zip(keys, first_addresses, self.parse_sentences(first_addresses)):
+                # Fallback parses are not cached, the key gets a full parse next time.
+                if not tree.degraded:
+                    self.cache.put(tokens, tree, tree.to_chunks())
+                for index in missing[key]:
+                    tree_with_words = replace_words(tree, addresses[index])
+                    results[index] = tree_with_words, tree_with_words.to_chunks()
+        return results
@@ -0,0 +1,562 @@
+import collections
+import functools
+import heapq
+import time
+
+import numpy as np
+
+import trees
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def get_spans(length):
+    return [
+        (left, left + span_length)
+        for span_length in range(1, length + 1)
+        for left in range(0, length + 1 - span_length)]
+
+
+@functools.lru_cache(maxsize=128)
+def get_span_positions(length):
+    spans = get_spans(length)
+    lefts = np.array([left for left, _ in spans], dtype=np.int64)
+    rights = np.array([right for _, right in spans], dtype=np.int64)
+    return lefts, rights
+
+
+def to_chart(span_scores, length, padded_length=None):
+    '''
+    :param span_scores: (labels x spans) array with the spans ordered as in get_spans(padded_length or length)
+    :param padded_length: length the spans were enumerated for when the sentence was padded in a minibatch
+    :return: (length + 1) x (length + 1) x labels array, label_scores[left, right] is the score vector of span (left, right)
+    '''
+    lefts, rights = get_span_positions(padded_length or length)
+    label_scores = np.zeros((length + 1, length + 1, span_scores.shape[0]), dtype=np.float32)
+    if padded_length is not None and padded_length != length:
+        inside = rights <= length
+        lefts, rights, span_scores = lefts[inside], rights[inside], span_scores[:, inside]
+    label_scores[lefts, rights] = span_scores.T
+    return label_scores
+
+
+def augment(label_scores, oracle_label_indices):
+    '''
+    Hamming cost: +1 for every label of a span except its oracle label.
+    '''
+    length = label_scores.shape[0] - 1
+    lefts, rights = get_span_positions(length)
+    augmented = label_scores.copy()
+    augmented[lefts, rights] += 1
+    augmented[lefts, rights, oracle_label_indices[lefts, rights]] -= 1
+    return augmented
+
+
+def best_labels(label_scores):
+    length = label_scores.shape[0] - 1
+    label_indices = label_scores.argmax(axis=2)
+    # The whole sentence must carry a non-empty label.
+    label_indices[0, length] = label_scores[0, length, 1:].argmax() + 1
+    span_label_scores = np.take_along_axis(label_scores, label_indices[:, :, None], axis=2)[:, :, 0]
+    return label_indices, span_label_scores
+
+
+def decode(label_scores, label_max_lengths=None, right_branching_labels=None, deadline=None):
+    '''
+    Right/left branching CKY over the label scores of all spans.
+
+    span_label_scores[left, right] is both the score of the flat span (left, right) and the label part of
+    chart[left, right]; chart[left, right] = span_label_scores[left, right] + the best of
+        span_label_scores[left, split] + chart[split, right]   (branching 0: right branching)
+        chart[left, split] + span_label_scores[split, right]   (branching 1: left branching)
+    Ties are broken as in ChartDynamicRBTConstraintParser.parse: smallest split, right branching first.
+
+    :param label_max_lengths: optional array, the longest flat span (chunk) allowed for each label index;
+        only splits leaving a flat span within the bound are searched, O(n^2 * L) instead of O(n^3)
+    :param right_branching_labels: optional boolean array over the label indices; spans whose label is
+        marked only search right-branching splits (see latent_tree_builder.get_right_branching_labels)
+    :param deadline: time.time() after which DeadlineExceeded is raised, checked once per span length
+    :return: label_indices, splits, branchings (backpointers) and the score of the best tree
+    '''
+    label_indices, splits, branchings, chart, _, _ = fill_chart(
+        label_scores, label_max_lengths, right_branching_labels, deadline)
+    return label_indices, splits, branchings, float(chart[0, -1])
+
+
+def fill_chart(label_scores, label_max_lengths=None, right_branching_labels=None, deadline=None):
+    '''
+    :return: the backpointers of decode, the chart of best tree scores, the best label score of every span and
+        the flat span scores (-inf where the flat span is too long for its label)
+    '''
+    length = label_scores.shape[0] - 1
+    label_indices, span_label_scores = best_labels(label_scores)
+
+    flat_scores = span_label_scores
+    max_chunk_length = length
+    if label_max_lengths is not None:
+        max_chunk_length = max(1, min(length, int(label_max_lengths.max())))
+        span_lengths = np.arange(length + 1)[None, :] - np.arange(length + 1)[:, None]
+        flat_scores = np.where(
+            span_lengths <= np.maximum(label_max_lengths[label_indices], 1), span_label_scores, -np.inf)
+
+    chart = np.zeros((length + 1, length + 1), dtype=np.float32 if label_scores.dtype == np.float32 else np.float64)
+    splits = np.zeros((length + 1, length + 1), dtype=np.int64)
+    branchings = np.zeros((length + 1, length + 1), dtype=np.int64)
+
+    right_only = None
+    if right_branching_labels is not None:
+        right_only = right_branching_labels[label_indices]
+
+    lefts = np.arange(length)
+    chart[lefts, lefts + 1] = span_label_scores[lefts, lefts + 1]
+
+    for span_length in range(2, length + 1):
+        if deadline is not None and time.time() > deadline:
+            raise DeadlineExceeded()
+        lefts = np.arange(0, length + 1 - span_length)[:, None]
+        rights = lefts + span_length
+        # The flat part of the split is [left, split) when right branching and [split, right) when left branching.
+        right_offsets = np.arange(1, min(span_length - 1, max_chunk_length) + 1)
+        left_offsets = np.arange(max(1, span_length - max_chunk_length), span_length)
+        right_splits = lefts + right_offsets[None, :]
+        left_splits = lefts + left_offsets[None, :]
+
+        right_branching = flat_scores[lefts, right_splits] + chart[right_splits, rights]
+        left_branching = chart[lefts, left_splits] + flat_scores[left_splits, rights]
+        if right_only is not None:
+            # Spans labelled as part of the right-branching spine of the latent trees cannot branch left.
+            left_branching[right_only[lefts[:, 0], rights[:, 0]]] = -np.inf
+        candidates = np.concatenate([right_branching, left_branching], axis=1)
+        best = candidates.argmax(axis=1)
+
+        lefts, rights = lefts[:, 0], rights[:, 0]
+        is_left_branching = best >= len(right_offsets)
+        branchings[lefts, rights] = is_left_branching
+        splits[lefts, rights] = lefts + np.where(
+            is_left_branching,
+            left_offsets[np.maximum(best - len(right_offsets), 0)],
+            right_offsets[np.minimum(best, len(right_offsets) - 1)])
+        chart[lefts, rights] = span_label_scores[lefts, rights] + candidates[np.arange(len(lefts)), best]
+
+    return label_indices, splits, branchings, chart, span_label_scores, flat_scores
+
+
+def oracle_decode(label_scores, label_indices, oracle_splits, latent):
+    '''
+    The oracle pass of ChartDynamicRBTConstraintParser.parse over the label score chart: every span keeps its
+    label in label_indices and splits right branching at its first gold split, except the latent spans, which
+    take the better of right branching at the first gold split and left branching at the last one.
+    Only the spans the oracle tree may go through are scored, top-down from the whole sentence: the gold spans
+    and, in the latent region, the spans between its chunk boundaries.
+
+    :param oracle_splits: function from (left, right) to the sorted gold splits of a span longer than 1
+    :param latent: (length + 1) x (length + 1) boolean array of the latent spans
+    :return: label_indices, splits, branchings, score as decode, splits and branchings are dicts over the
+        scored spans
+    '''
+    length = label_scores.shape[0] - 1
+    span_label_scores = np.take_along_axis(label_scores, label_indices[:, :, None], axis=2)[:, :, 0]
+    splits = {}
+    branchings = {}
+
+    @functools.lru_cache(maxsize=None)
+    def chart(left, right):
+        label_score = float(span_label_scores[left, right])
+        if right - left == 1:
+            return label_score
+
+        candidates = oracle_splits(left, right)
+        split, branching = candidates[0] if latent[left, right] else min(candidates), 0
+        best = float(span_label_scores[left, split]) + chart(split, right)
+        if latent[left, right]:
+            last = candidates[-1]
+            left_branching = chart(left, last) + float(span_label_scores[last, right])
+            if left_branching > best:
+                split, branching, best = last, 1, left_branching
+        splits[left, right], branchings[left, right] = split, branching
+        return label_score + best
+
+    return label_indices, splits, branchings, chart(0, length)
+
+
+def get_chunk_label_indices(label_vocab):
+    '''
+    :return: indices of the chunk labels, the non-empty labels that are not the primed (latent) labels
+    '''
+    return np.array([
+        index for index, label in enumerate(label_vocab.values)
+        if len(label) == 1 and not label[0].endswith("'") and not label[0].startswith("<")], dtype=np.int64)
+
+
+def segment(label_scores, chunk_label_indices, max_length=None, label_max_lengths=None):
+    '''
+    Semi-Markov segmentation: the best sequence of labelled chunks covering the sentence, scored by the sum of
+    their label scores, in O(n * max_length * labels) instead of the cubic chart.
+
+    :param chunk_label_indices: label indices a chunk may carry, see get_chunk_label_indices
+    :param max_length: longest chunk, the sentence length if None
+    :param label_max_lengths: optional per-label bound as in decode
+    :return: [(left, right, label_index)] in order and the segmentation score
+    '''
+    length = label_scores.shape[0] - 1
+    max_length = min(max_length or length, length)
+    scores = label_scores[:, :, chunk_label_indices]
+    if label_max_lengths is not None:
+        span_lengths = np.arange(length + 1)[None, :] - np.arange(length + 1)[:, None]
+        bounds = np.maximum(label_max_lengths[chunk_label_indices], 1)
+        scores = np.where(span_lengths[:, :, None] <= bounds[None, None, :], scores, -np.inf)
+
+    best = np.full(length + 1, -np.inf)
+    best[0] = 0
+    back_lefts = np.zeros(length + 1, dtype=np.int64)
+    back_labels = np.zeros(length + 1, dtype=np.int64)
+    for right in range(1, length + 1):
+        lefts = np.arange(max(0, right - max_length), right)
+        candidates = best[lefts][:, None] + scores[lefts, right]
+        left_index, label_index = np.unravel_index(candidates.argmax(), candidates.shape)
+        best[right] = candidates[left_index, label_index]
+        back_lefts[right] = lefts[left_index]
+        back_labels[right] = chunk_label_indices[label_index]
+
+    segments = []
+    right = length
+    while right > 0:
+        segments.append((int(back_lefts[right]), right, int(back_labels[right])))
+        right = int(back_lefts[right])
+    return segments[::-1], float(best[length])
+
+
+def segments_to_chunks(sentence, label_vocab, segments):
+    '''
+    :return: chunks as trees.InternalTreebankNode.to_chunks, (label, left, right, words)
+    '''
+    return [
+        (label_vocab.value(label_index)[0], left, right, [word for _, word in sentence[left:right]])
+        for left, right, label_index in segments]
+
+
+def segments_to_tree(sentence, label_vocab, segments):
+    '''
+    :return: right-branching tree over the flat chunks of segments, each parent labelled after its left chunk
+    '''
+    nodes = [
+        trees.InternalParseNode(label_vocab.value(label_index), [
+            trees.LeafParseNode(position, *sentence[position]) for position in range(left, right)])
+        for left, right, label_index in segments]
+    tree = nodes[-1]
+    for node in reversed(nodes[:-1]):
+        tree = trees.InternalParseNode((node.label[0] + "'",), [node, tree])
+    return tree
+
+
+def fallback_parse(sentence, label_vocab, label_scores, label_max_lengths=None):
+    '''
+    Cheap replacement for decode on inputs that would miss their deadline: semi-Markov chunking over the
+    label scores and a right-branching tree over the chunks, flagged as degraded.
+    '''
+    segments, score = segment(label_scores, get_chunk_label_indices(label_vocab), None, label_max_lengths)
+    tree = segments_to_tree(sentence, label_vocab, segments)
+    tree.degraded = True
+    return tree, score
+
+
+def get_decode_cells(length, label_max_lengths=None):
+    '''
+    :return: the number of split candidates decode scores for a sentence of length
+    '''
+    max_chunk_length = length if label_max_lengths is None else max(1, min(length, int(label_max_lengths.max())))
+    span_lengths = np.arange(2, length + 1)
+    return int(((length + 1 - span_lengths) * 2 * np.minimum(span_lengths - 1, max_chunk_length)).sum())
+
+
+class DeadlineDecoder(object):
+    '''
+    decode under a time budget per sentence. The cost of a sentence is estimated from its number of chart cells
+    and the measured seconds per cell; a sentence is decoded by fallback_parse right away when the estimate
+    overshoots its deadline, or when the deadline passes while decoding.
+    '''
+
+    # Sentences smaller than this are dominated by per-call overhead and do not update the estimate.
+    min_calibration_cells = 10000
+
+    def __init__(self, label_vocab, label_max_lengths=None, right_branching_labels=None):
+        self.label_vocab = label_vocab
+        self.label_max_lengths = label_max_lengths
+        self.right_branching_labels = right_branching_labels
+        self.seconds_per_cell = None
+        self.decoded = 0
+        self.estimated_fallbacks = 0
+        self.timeout_fallbacks = 0
+
+    def fallback(self, sentence, label_scores):
+        return fallback_parse(sentence, self.label_vocab, label_scores, self.label_max_lengths)
+
+    def decode(self, sentence, label_scores, time_budget=None, parse_start_time=None):
+        '''
+        :param time_budget: seconds the parse of this sentence may take, from parse_start_time
+        :param parse_start_time: time.time() when the parser started on the sentence, before its label scores
+            were computed; now if None
+        :return: (tree, score), tree.degraded is set when the fallback was used
+        '''
+        start_time = time.time()
+        deadline = None if time_budget is None else (parse_start_time or start_time) + time_budget
+        cells = get_decode_cells(len(sentence), self.label_max_lengths)
+        if deadline is not None and self.seconds_per_cell is not None and \
+                start_time + cells * self.seconds_per_cell > deadline:
+            self.estimated_fallbacks += 1
+            return self.fallback(sentence, label_scores)
+
+        try:
+            label_indices, splits, branchings, score = decode(
+                label_scores, self.label_max_lengths, self.right_branching_labels, deadline)
+        except DeadlineExceeded:
+            self.timeout_fallbacks += 1
+            return self.fallback(sentence, label_scores)
+
+        if cells >= self.min_calibration_cells:
+            seconds_per_cell = (time.time() - start_time) / cells
+            self.seconds_per_cell = seconds_per_cell if self.seconds_per_cell is None else \
+                0.9 * self.seconds_per_cell + 0.1 * seconds_per_cell
+        self.decoded += 1
+        tree, _ = backtrack(sentence, self.label_vocab, label_indices, splits, branchings)
+        return tree, score
+
+    def stats(self):
+        return collections.OrderedDict([
+            ("decoded", self.decoded),
+            ("estimated_fallbacks", self.estimated_fallbacks),
+            ("timeout_fallbacks", self.timeout_fallbacks),
+            ("seconds_per_cell", self.seconds_per_cell),
+        ])
+
+
+def backtrack(sentence, label_vocab, label_indices, splits, branchings):
+    '''
+    Builds the tree of the backpointer chart once.
+
+    :return: the tree and the (left, right, label_index) of every span whose label score is part of the tree score
+    '''
+    tree_spans = []
+
+    def leaf(left):
+        tag, word = sentence[left]
+        return trees.LeafParseNode(left, tag, word)
+
+    def flat(left, right):
+        label_index = int(label_indices[left, right])
+        tree_spans.append((left, right, label_index))
+        label = label_vocab.value(label_index)
+        if right - left == 1:
+            children = [leaf(left)]
+            return [trees.InternalParseNode(label, children)] if label else children
+        children = [leaf(pos) for pos in range(left, right)]
+        if label and not label[0].endswith("'"):
+            return [trees.InternalParseNode(label, children)]
+        return children
+
+    def helper(left, right):
+        if right - left == 1:
+            return flat(left, right)
+
+        label_index = int(label_indices[left, right])
+        tree_spans.append((left, right, label_index))
+        label = label_vocab.value(label_index)
+
+        split = int(splits[left, right])
+        if branchings[left, right] == 0:
+            children = flat(left, split) + helper(split, right)
+        else:
+            children = helper(left, split) + flat(split, right)
+
+        if label:
+            children = [trees.InternalParseNode(label, children)]
+        return children
+
+    children = helper(0, len(sentence))
+    assert len(children) == 1
+    return children[0], tree_spans
+
+
+class KBestChart(object):
+    '''
+    Lazy k-best derivations of the decode chart (Huang and Chiang 2005, algorithm 3).
+
+    The hypergraph has three kinds of nodes: ("node", left, right), a span of the chart, ("label", left,
+    right), the label of a chart span, and ("flat", left, right), a flat span and its label. A chart node
+    longer than one has one hyperedge per (split, branching) whose tails are (label, flat, node) when right
+    branching and (label, node, flat) when left branching, as in decode. A derivation is a
+    (score, edge_index, ranks) triple holding the ranks of its tails' derivations; label and flat nodes have
+    one derivation per label, (score, None, (label_index,)), read from their sorted labels when asked for.
+
+    The 1-best chart of fill_chart gives the best derivation of every hyperedge, so a node sorts its
+    max_derivations best hyperedges without recursion and its candidate heap holds only the next unexpanded
+    hyperedge besides the successors of the derivations taken so far. Nodes are only expanded when a
+    derivation reaches them, and each further derivation costs a few heap operations.
+    '''
+
+    def __init__(self, label_scores, max_derivations, label_max_lengths=None, right_branching_labels=None):
+        '''
+        :param max_derivations: derivations of the whole sentence that may be asked for; no node needs more
+        :param right_branching_labels: as in decode, a span whose best label is marked has no left-branching
+            hyperedges
+        '''
+        # float64 so that derivation scores summed tail by tail match the chart scores.
+        self.label_scores = label_scores.astype(np.float64)
+        self.max_derivations = max_derivations
+        self.length = label_scores.shape[0] - 1
+        self.label_max_lengths = label_max_lengths
+        label_indices, _, _, self.chart, self.span_label_scores, self.flat_scores = fill_chart(
+            self.label_scores, label_max_lengths, right_branching_labels)
+        self.right_only = None
+        if right_branching_labels is not None:
+            self.right_only = right_branching_labels[label_indices]
+        self.labels = {}
+        self.derivations = {}
+        self.candidates = {}
+        self.edges = {}
+        self.seen = {}
+
+    def get_labels(self, kind, left, right):
+        '''
+        :return: the label indices of a label or flat node, best first
+        '''
+        scores = self.label_scores[left, right]
+        order = np.argsort(-scores, kind="stable")
+        if kind == "label" and (left, right) == (0, self.length):
+            order = order[order != 0]
+        elif kind == "flat" and self.label_max_lengths is not None:
+            # As in fill_chart: a flat span is dropped when its best label is longer than allowed.
+            bounds = np.maximum(self.label_max_lengths, 1)
+            if bounds[order[0]] < right - left:
+                order = order[:0]
+            order = order[bounds[order] >= right - left]
+        return order[:self.max_derivations]
+
+    def get_edge(self, left, right, edge_index):
+        '''
+        :return: (split, branching) and the (label, left, right) tails of a hyperedge, right branching edges
+            first, smallest split first, as the ties of decode
+        '''
+        split = left + 1 + edge_index % (right - left - 1)
+        if edge_index < right - left - 1:
+            return (split, 0), (("label", left, right), ("flat", left, split), ("node", split, right))
+        return (split, 1), (("label", left, right), ("node", left, split), ("flat", split, right))
+
+    def init_candidates(self, node):
+        _, left, right = node
+        splits = np.arange(left + 1, right)
+        edge_scores = self.span_label_scores[left, right] + np.concatenate([
+            self.flat_scores[left, splits] + self.chart[splits, right],
+            self.chart[left, splits] + self.flat_scores[splits, right]])
+        if self.right_only is not None and self.right_only[left, right]:
+            edge_scores[len(splits):] = -np.inf
+        best_edges = np.argsort(-edge_scores, kind="stable")[:self.max_derivations]
+        best_edges = best_edges[np.isfinite(edge_scores[best_edges])]
+        self.edges[node] = list(zip((-edge_scores[best_edges]).tolist(), best_edges.tolist()))
+        self.derivations[node] = []
+        self.candidates[node] = []
+        self.seen[node] = set()
+        self.push_edge(node, 0)
+
+    def push_edge(self, node, position):
+        # The best derivations of the hyperedges come out of the heap in the order of self.edges, so the next
+        # hyperedge only joins the heap once the best derivation of the previous one is taken.
+        if position < len(self.edges[node]):
+            negative_score, edge_index = self.edges[node][position]
+            self.seen[node].add((edge_index, (0, 0, 0)))
+            heapq.heappush(self.candidates[node], (negative_score, edge_index, (0, 0, 0), position))
+
+    def push_successors(self, node, edge_index, ranks):
+        _, left, right = node
+        _, tails = self.get_edge(left, right, edge_index)
+        for i in range(len(ranks)):
+            successor = ranks[:i] + (ranks[i] + 1,) + ranks[i + 1:]
+            if (edge_index, successor) in self.seen[node]:
+                continue
+            self.seen[node].add((edge_index, successor))
+            derivations = [self.get(tail, rank) for tail, rank in zip(tails, successor)]
+            if all(derivation is not None for derivation in derivations):
+                score = sum(derivation[0] for derivation in derivations)
+                heapq.heappush(self.candidates[node], (-score, edge_index, successor, None))
+
+    def get(self, node, rank):
+        '''
+        :return: the rank-th best (score, edge_index, ranks) derivation of node, None if there are fewer
+        '''
+        kind, left, right = node
+        if kind != "node" or right - left == 1:
+            if node not in self.labels:
+                self.labels[node] = self.get_labels("label" if kind == "node" else kind, left, right)
+            labels = self.labels[node]
+            if rank >= len(labels):
+                return None
+            return float(self.label_scores[left, right, labels[rank]]), None, (int(labels[rank]),)
+
+        if node not in self.derivations:
+            self.init_candidates(node)
+        derivations = self.derivations[node]
+        candidates = self.candidates[node]
+        while len(derivations) <= rank:
+            if derivations:
+                _, edge_index, ranks = derivations[-1]
+                self.push_successors(node, edge_index, ranks)
+            if not candidates:
+                break
+            negative_score, edge_index, ranks, position = heapq.heappop(candidates)
+            if position is not None:
+                self.push_edge(node, position + 1)
+            derivations.append((-negative_score, edge_index, ranks))
+        return derivations[rank] if rank < len(derivations) else None
+
+    def get_backpointers(self, rank):
+        '''
+        :return: label_indices, splits and branchings dicts of the rank-th best derivation, for backtrack
+        '''
+        label_indices, splits, branchings = {}, {}, {}
+        stack = [(("node", 0, self.length), rank)]
+        while stack:
+            node, node_rank = stack.pop()
+            _, left, right = node
+            _, edge_index, ranks = self.get(node, node_rank)
+            if edge_index is None:
+                label_indices[left, right] = ranks[0]
+                continue
+            (splits[left, right], branchings[left, right]), (label_tail, *child_tails) = self.get_edge(left, right, edge_index)
+            label_indices[left, right] = self.get(label_tail, ranks[0])[2][0]
+            stack.extend(zip(child_tails, ranks[1:]))
+        return label_indices, splits, branchings
+
+    def kbest(self, sentence, label_vocab, k):
+        '''
+        :return: up to k [(tree, score)] with distinct trees, best first, from at most max_derivations
+            derivations
+        '''
+        # Different derivations can give the same tree when flat primed spans are dissolved, so derivations are
+        # told apart by the labelled spans that stay in the tree, without building it.
+        dissolved = np.array([not label or label[0].endswith("'") for label in label_vocab.values])
+        results = []
+        seen_trees = set()
+        for rank in range(self.max_derivations):
+            derivation = self.get(("node", 0, self.length), rank)
+            if derivation is None or len(results) == k:
+                break
+            label_indices, splits, branchings = self.get_backpointers(rank)
+            tree_spans = frozenset(
+                (left, right, label_index) for (left, right), label_index in label_indices.items()
+                if label_index != 0 and (right - left == 1 or (left, right) in splits or not dissolved[label_index]))
+            if tree_spans not in seen_trees:
+                seen_trees.add(tree_spans)
+                tree, _ = backtrack(sentence, label_vocab, label_indices, splits, branchings)
+                results.append((tree, derivation[0]))
+        return results
+
+
+def kbest(sentence, label_vocab, label_scores, k, label_max_lengths=None, max_derivations=None, right_branching_labels=None):
+    '''
+    :param max_derivations: derivations to try before giving up on k distinct trees, 10 k by default
+    :return: up to k [(tree, score)] with distinct trees, best first; the first one is the decode parse
+    '''
+    kbest_chart = KBestChart(label_scores, max_derivations or 10 * k, label_max_lengths, right_branching_labels)
+    return kbest_chart.kbest(sentence, label_vocab, k)
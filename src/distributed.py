@@ -0,0 +1,87 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+
+class ParameterAverager(object):
+    '''
+    Data-parallel training in forked processes that train on their own shard and periodically replace their
+    parameters with the average over all processes.
+
+    Every process copies its parameters to its row of a shared (workers x parameters) float32 array; after a
+    barrier each one averages its own slice of the columns, and after a second barrier all of them read the
+    averaged parameters back, so a synchronisation reads and writes the parameters about three times.
+    The trainer state (e.g. Adam moments) stays local to each process.
+    '''
+
+    def __init__(self, model, workers):
+        self.parameters = model.parameters_list() + model.lookup_parameters_list()
+        self.lookup = [False] * len(model.parameters_list()) + [True] * len(model.lookup_parameters_list())
+        self.shapes = [parameter.as_array().shape for parameter in self.parameters]
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.cumsum([0] + sizes)
+        self.workers = workers
+        self.rank = 0
+        self.pids = []
+
+        size = int(self.offsets[-1])
+        context = multiprocessing.get_context("fork")
+        self.rows = np.frombuffer(context.RawArray('f', workers * size), dtype=np.float32).reshape(workers, size)
+        self.mean = np.frombuffer(context.RawArray('f', size), dtype=np.float32)
+        self.processed = np.frombuffer(context.RawArray('d', workers), dtype=np.float64)
+        self.barrier = context.Barrier(workers)
+
+    def start(self):
+        '''
+        Forks workers - 1 processes that carry on from the caller with the current parameters.
+
+        :return: the rank of the process, 0 in the caller
+        '''
+        for rank in range(1, self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.rank = rank
+                self.pids = []
+                return rank
+            self.pids.append(pid)
+        return 0
+
+    def average(self, processed=0):
+        '''
+        Averages the parameters of all processes, every process must call it the same number of times.
+
+        :param processed: number of sentences this process trained on so far
+        :return: number of sentences all the processes trained on so far
+        '''
+        row = self.rows[self.rank]
+        for parameter, start, end in zip(self.parameters, self.offsets, self.offsets[1:]):
+            row[start:end] = parameter.as_array().ravel()
+        self.processed[self.rank] = processed
+        self.barrier.wait()
+
+        bounds = np.linspace(0, len(self.mean), self.workers + 1).astype(np.int64)
+        start, end = bounds[self.rank], bounds[self.rank + 1]
+        self.mean[start:end] = self.rows[:, start:end].mean(axis=0)
+        total_processed = self.processed.sum()
+        self.barrier.wait()
+
+        for parameter, lookup, shape, start, end in zip(
+                self.parameters, self.lookup, self.shapes, self.offsets, self.offsets[1:]):
+            value = self.mean[start:end].reshape(shape)
+            if lookup:
+                parameter.init_from_array(value)
+            else:
+                parameter.set_value(value)
+        return int(total_processed)
+
+    def abort(self):
+        # Processes waiting at the barrier get a BrokenBarrierError instead of waiting forever.
+        self.barrier.abort()
+
+    def join(self):
+        failed = 0
+        for pid in self.pids:
+            _, status = os.waitpid(pid, 0)
+            failed += status != 0
+        return failed
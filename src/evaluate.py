@@ -111,6 +111,21 @@ def get_performance(match_num, gold_num, pred_num):
     return p, r, f1
 
 
+def chunk_fscore(gold_chunks_list, pred_chunks_list):
+    '''
+    Exact-match chunk precision/recall/F1 in Python, without writing a conlleval file.
+    '''
+    match_num = 0
+    gold_num = 0
+    pred_num = 0
+    for gold_chunks, pred_chunks in zip(gold_chunks_list, pred_chunks_list):
+        match_num += count_common_chunks(gold_chunks, pred_chunks)
+        gold_num += len(gold_chunks)
+        pred_num += len(pred_chunks)
+    p, r, f1 = get_performance(match_num, max(gold_num, 1), max(pred_num, 1))
+    return FScore(r, p, f1)
+
+
 def get_text_from_chunks(chunks):
     text = []
     for chunk in chunks:
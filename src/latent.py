@@ -34,6 +34,20 @@ class latent_tree_builder:
         return label_order;
 
 
+    def get_right_branching_labels(self):
+        '''
+        :return: boolean array over the label indices, True for the labels of the right-branching part of
+            build_dynamicRBT_tree (label order >= RBT_order_before_idx); the empty label is never constrained
+        '''
+        import numpy as np
+
+        right_branching = np.zeros(self.label_vocab.size, dtype=bool)
+        for index, label in enumerate(self.label_vocab.values):
+            if len(label) == 1 and not label[0].startswith('<'):
+                right_branching[index] = self.get_label_order(label[0]) >= self.RBT_order_before_idx
+        return right_branching
+
+
     def non_terminal_label(self, label):
         if label[-1] == "'":
             return label
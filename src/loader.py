@@ -0,0 +1,77 @@
+import numpy as np
+
+
+def get_length_batches(lengths, batch_size, random=np.random):
+    '''
+    Minibatches of sentences of similar length for training: the sentences are shuffled, stably sorted by
+    length and cut into batches of batch_size, and the order of the batches is shuffled, so batches are padded
+    little but neither their content nor their order repeats between epochs.
+
+    :param lengths: length of every training sentence
+    :param random: np.random or a np.random.RandomState
+    :return: list of arrays of sentence indices
+    '''
+    lengths = np.asarray(lengths)
+    order = random.permutation(len(lengths))
+    order = order[np.argsort(lengths[order], kind="stable")]
+    batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+    random.shuffle(batches)
+    return batches
+
+
+class TrainLoader(object):
+    '''
+    Epoch minibatches over the training instances (x, tree, chunks, latentscope). The instances with a chunk
+    longer than max_chunk_length are filtered out once; an epoch only shuffles arrays of instance indices,
+    with a random state seeded by (seed, epoch), so the batches of any epoch can be rebuilt to resume training.
+    With workers > 1 the loader only holds the shard of rank, every workers-th kept instance.
+    '''
+
+    def __init__(self, instances, batch_size, max_chunk_length=None, length_buckets=False, seed=0, rank=0, workers=1):
+        self.instances = instances
+        self.batch_size = batch_size
+        self.length_buckets = length_buckets
+        self.seed = seed
+        self.workers = workers
+
+        kept = [
+            index for index, (_, _, chunks, _) in enumerate(instances)
+            if max_chunk_length is None or all(right - left <= max_chunk_length for _, left, right in chunks)]
+        self.kept = len(kept)
+        kept = kept[rank::workers]
+        self.indices = np.array(kept, dtype=np.int64)
+        self.lengths = np.array([len(instances[index][0]) for index in kept], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    @property
+    def discarded(self):
+        return len(self.instances) - self.kept
+
+    def get_min_batch_count(self):
+        '''
+        :return: number of batches per epoch of the smallest shard
+        '''
+        return -(-(self.kept // self.workers) // self.batch_size)
+
+    def get_batches(self, epoch):
+        '''
+        :return: list of arrays of instance indices, the same for the same seed and epoch
+        '''
+        random = np.random.RandomState([self.seed, epoch])
+        if self.length_buckets:
+            batches = get_length_batches(self.lengths, self.batch_size, random)
+        else:
+            order = random.permutation(len(self.indices))
+            batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        return [self.indices[batch] for batch in batches]
+
+    def epoch(self, epoch, start_batch=0):
+        '''
+        :param start_batch: number of batches of the epoch already trained on
+        :return: generator of (batch_number, batch_count, instances), batch_number counted from 1
+        '''
+        batches = self.get_batches(epoch)
+        for batch_number in range(start_batch + 1, len(batches) + 1):
+            yield batch_number, len(batches), [self.instances[index] for index in batches[batch_number - 1]]
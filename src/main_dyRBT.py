@@ -1,17 +1,52 @@
 import argparse
+import contextlib
 import itertools
+import multiprocessing
+import os
 import os.path
+import shutil
+import sys
 import time
+import traceback
 
 seed = 3986067777
-import dynet_config
-dynet_config.set(random_seed = seed)
-import dynet as dy
+
+
+def get_argv_option(name, default=None):
+    # DyNet ignores its command line options once dynet_config is set, so they are passed on from sys.argv.
+    for i, arg in enumerate(sys.argv):
+        if arg == name and i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+        if arg.startswith(name + "="):
+            return arg[len(name) + 1:]
+    return default
+
+
+def import_dynet():
+    '''
+    Imports DyNet and the modules built on it, only on the paths that need them, so the numpy engine runs
+    without DyNet installed.
+    '''
+    global dy, parallel, parse
+    import dynet_config
+    dynet_config.set(random_seed = seed, autobatch = int(get_argv_option("--dynet-autobatch", 0)))
+    import dynet as dy
+    import parallel
+    import parse
+
 
 import numpy as np
 
+import cache
+import chart
+import distributed
 import evaluate
-import parse
+import loader
+import npparser
+import prefixcache
+import prefork
+import server
+import stream
 import trees
 import vocabulary
 
@@ -30,9 +65,147 @@ def format_elapsed(start_time):
     return elapsed_string
 
 
+class CheckpointEvaluator(object):
+    def __init__(self, dev_chunk_insts, test_chunk_insts, model_path_base, expname, evalb_dir, start_time):
+        self.dev_chunk_insts = dev_chunk_insts
+        self.test_chunk_insts = test_chunk_insts
+        self.model_path_base = model_path_base
+        self.expname = expname
+        self.evalb_dir = evalb_dir
+        self.start_time = start_time
+        self.best_dev_fscore = -np.inf
+        self.best_dev_model_path = None
+
+    def check(self, epoch, parse_sentences, save_model):
+        '''
+        :param parse_sentences: function from a list of sentences to their predicted trees
+        :param save_model: function saving the evaluated parameters under a path
+        :return: True if the dev score improved and the model was saved as the new best one
+        '''
+        dev_start_time = time.time()
+
+        dev_predicted = []
+        #dev_gold = []
+
+        #dev_gold = latent_tree.build_latent_trees(dev_chunk_insts)
+        dev_gold = []
+        for inst in self.dev_chunk_insts:
+            chunks = util.inst2chunks(inst)
+            dev_gold.append(chunks)
+
+        dev_sentences = [[(parse.XX, ch) for ch in x] for x, chunks in self.dev_chunk_insts]
+        for predicted in parse_sentences(dev_sentences):
+            dev_predicted.append(predicted.convert().to_chunks())
+
+
+        #dev_fscore = evaluate.evalb(args.evalb_dir, dev_gold, dev_predicted, args.expname + '.dev.') #evalb
+        dev_fscore = evaluate.eval_chunks2(self.evalb_dir, dev_gold, dev_predicted, output_filename=self.expname + '.dev.txt')  # evalb
+
+
+        print(
+            "dev-fscore {} "
+            "dev-elapsed {} "
+            "total-elapsed {}".format(
+                dev_fscore,
+                format_elapsed(dev_start_time),
+                format_elapsed(self.start_time),
+            )
+        )
+
+
+        if dev_fscore.fscore <= self.best_dev_fscore:
+            return False
+
+        if self.best_dev_model_path is not None:
+            for ext in [".data", ".meta"]:
+                path = self.best_dev_model_path + ext
+                if os.path.exists(path):
+                    print("Removing previous model file {}...".format(path))
+                    os.remove(path)
+
+        self.best_dev_fscore = dev_fscore.fscore
+        self.best_dev_model_path = "{}_dev={:.2f}".format(self.model_path_base + "_" + self.expname, dev_fscore.fscore)
+        print("Saving new best model to {}...".format(self.best_dev_model_path))
+        save_model(self.best_dev_model_path)
+
+        test_start_time = time.time()
+        test_predicted = []
+        #test_gold = latent_tree.build_latent_trees(test_chunk_insts)
+        test_gold = []
+        for inst in self.test_chunk_insts:
+            chunks = util.inst2chunks(inst)
+            test_gold.append(chunks)
+
+        ftreelog = open(self.expname + '.test.predtree.txt', 'w', encoding='utf-8')
+
+        test_sentences = [[(parse.XX, ch) for ch in x] for x, chunks in self.test_chunk_insts]
+        for predicted in parse_sentences(test_sentences):
+            pred_tree = predicted.convert()
+            ftreelog.write(pred_tree.linearize() + '\n')
+            test_predicted.append(pred_tree.to_chunks())
+
+
+
+        ftreelog.close()
+
+        #test_fscore = evaluate.evalb(args.evalb_dir, test_chunk_insts, test_predicted, args.expname + '.test.')
+        test_fscore = evaluate.eval_chunks2(self.evalb_dir, test_gold, test_predicted, output_filename=self.expname + '.test.txt')  # evalb
+
+        print(
+            "epoch {:,} "
+            "test-fscore {} "
+            "test-elapsed {} "
+            "total-elapsed {}".format(
+                epoch,
+                test_fscore,
+                format_elapsed(test_start_time),
+                format_elapsed(self.start_time),
+            ), flush=True
+        )
+        return True
+
+
+def remove_model(path):
+    for ext in [".data", ".meta"]:
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+
+
+def run_checkpoint_evaluator(eval_queue, checkpoint_evaluator, eval_workers, eval_batch_size):
+    '''
+    Background evaluation loop for --async-eval: evaluates the snapshots put on eval_queue in order until it
+    receives None. A snapshot that improves dev is copied to the best model, every snapshot is deleted once
+    evaluated.
+    '''
+    import_dynet()
+    while True:
+        item = eval_queue.get()
+        if item is None:
+            break
+        epoch, snapshot_path = item
+
+        dy.renew_cg()
+        model = dy.ParameterCollection()
+        [parser] = dy.load(snapshot_path, model)
+
+        def parse_sentences(sentences):
+            if eval_workers > 1:
+                return parallel.parse_sentences(snapshot_path, sentences, eval_workers, eval_batch_size)
+            return parse.parse_sentences(parser, sentences, eval_batch_size)
+
+        def save_model(path):
+            # Copied, the eval workers still load the snapshot to parse the test set.
+            for ext in [".data", ".meta"]:
+                if os.path.exists(snapshot_path + ext):
+                    shutil.copyfile(snapshot_path + ext, path + ext)
+
+        print("Evaluating snapshot {} of epoch {:,}...".format(snapshot_path, epoch))
+        checkpoint_evaluator.check(epoch, parse_sentences, save_model)
+        remove_model(snapshot_path)
 
 
 def run_train(args):
+    import_dynet()
 
     args.numpy_seed = seed
     if args.numpy_seed is not None:
@@ -120,6 +293,14 @@ def run_train(args):
     pretrain = {'giga':'data/giga.vec100', 'none':'none'}
     pretrainemb = util.load_pretrain(pretrain[args.pretrainemb], args.word_embedding_dim, word_vocab)
 
+    chunk_length_limits = None
+    if args.chunkbound > 0:
+        chunk_length_limits = util.get_chunk_length_limits(train_chunk_insts, args.maxllimit)
+        if args.chunkbound == 1:
+            max_chunk_length = max(chunk_length_limits.values())
+            chunk_length_limits = {label: max_chunk_length for label in chunk_length_limits}
+        print("Chunk length limits for decoding: {}".format(chunk_length_limits))
+
     model = dy.ParameterCollection()
     if args.parser_type == "chartdyRBTC":
         parser = parse.ChartDynamicRBTConstraintParser(
@@ -136,8 +317,12 @@ def run_train(args):
             (args.pretrainemb, pretrainemb),
             args.chunkencoding,
             args.trainc == 1,
-            True,
+            args.decodec == 1,
             (args.zerocostchunk == 1),
+            span_batch=(args.spanbatch == 1),
+            decoder=args.decoder,
+            chunk_length_limits=chunk_length_limits,
+            RBTlabel=args.RBTlabel,
         )
 
 
@@ -154,170 +339,192 @@ def run_train(args):
 
     total_processed = 0
     current_processed = 0
-    check_every = len(train_chunk_insts) / args.checks_per_epoch
-    best_dev_fscore = -np.inf
-    best_dev_model_path = None
 
     start_time = time.time()
 
-    def check_dev():
-        nonlocal best_dev_fscore
-        nonlocal best_dev_model_path
-
-        dev_start_time = time.time()
-
-        dev_predicted = []
-        #dev_gold = []
-
-        #dev_gold = latent_tree.build_latent_trees(dev_chunk_insts)
-        dev_gold = []
-        for inst in dev_chunk_insts:
-            chunks = util.inst2chunks(inst)
-            dev_gold.append(chunks)
-
-        for x, chunks in dev_chunk_insts:
-            dy.renew_cg()
-            #sentence = [(leaf.tag, leaf.word) for leaf in tree.leaves()]
-            sentence = [(parse.XX, ch) for ch in x]
-            predicted, _ = parser.parse(sentence)
-            dev_predicted.append(predicted.convert().to_chunks())
+    checkpoint_evaluator = CheckpointEvaluator(
+        dev_chunk_insts, test_chunk_insts, args.model_path_base, args.expname, args.evalb_dir, start_time)
 
+    snapshot_count = 0
+    if args.async_eval:
+        # Checkpoints are snapshotted to disk and evaluated by a background
+        # process, training carries on meanwhile.
+        context = multiprocessing.get_context("spawn")
+        eval_queue = context.Queue()
+        evaluator_process = context.Process(
+            target=run_checkpoint_evaluator,
+            args=(eval_queue, checkpoint_evaluator, args.eval_workers, args.eval_batch_size))
+        evaluator_process.start()
 
-        #dev_fscore = evaluate.evalb(args.evalb_dir, dev_gold, dev_predicted, args.expname + '.dev.') #evalb
-        dev_fscore = evaluate.eval_chunks2(args.evalb_dir, dev_gold, dev_predicted, output_filename=args.expname + '.dev.txt')  # evalb
-
-
-        print(
-            "dev-fscore {} "
-            "dev-elapsed {} "
-            "total-elapsed {}".format(
-                dev_fscore,
-                format_elapsed(dev_start_time),
-                format_elapsed(start_time),
-            )
-        )
-
-
-        if dev_fscore.fscore > best_dev_fscore:
-            if best_dev_model_path is not None:
-                for ext in [".data", ".meta"]:
-                    path = best_dev_model_path + ext
-                    if os.path.exists(path):
-                        print("Removing previous model file {}...".format(path))
-                        os.remove(path)
-
-            best_dev_fscore = dev_fscore.fscore
-            best_dev_model_path = "{}_dev={:.2f}".format(args.model_path_base + "_" + args.expname, dev_fscore.fscore)
-            print("Saving new best model to {}...".format(best_dev_model_path))
-            dy.save(best_dev_model_path, [parser])
-
-            test_start_time = time.time()
-            test_predicted = []
-            #test_gold = latent_tree.build_latent_trees(test_chunk_insts)
-            test_gold = []
-            for inst in test_chunk_insts:
-                chunks = util.inst2chunks(inst)
-                test_gold.append(chunks)
-
-            ftreelog = open(args.expname + '.test.predtree.txt', 'w', encoding='utf-8')
-
-            for x, chunks in test_chunk_insts:
-                dy.renew_cg()
-                #sentence = [(leaf.tag, leaf.word) for leaf in tree.leaves()]
-                sentence = [(parse.XX, ch) for ch in x]
-                predicted, _ = parser.parse(sentence)
-                pred_tree = predicted.convert()
-                ftreelog.write(pred_tree.linearize() + '\n')
-                test_predicted.append(pred_tree.to_chunks())
+    def check_dev():
+        nonlocal snapshot_count
 
+        if args.async_eval:
+            snapshot_count += 1
+            snapshot_path = "{}_{}_snapshot{}".format(args.model_path_base, args.expname, snapshot_count)
+            dy.save(snapshot_path, [parser])
+            eval_queue.put((epoch, snapshot_path))
+            return
 
+        if args.eval_workers > 1:
+            # Workers load the current parameters from disk once per check.
+            eval_model_path = args.model_path_base + "_" + args.expname + "_eval"
+            dy.save(eval_model_path, [parser])
 
-            ftreelog.close()
+        def parse_sentences(sentences):
+            if args.eval_workers > 1:
+                return parallel.parse_sentences(eval_model_path, sentences, args.eval_workers, args.eval_batch_size)
+            return parse.parse_sentences(parser, sentences, args.eval_batch_size)
 
-            #test_fscore = evaluate.evalb(args.evalb_dir, test_chunk_insts, test_predicted, args.expname + '.test.')
-            test_fscore = evaluate.eval_chunks2(args.evalb_dir, test_gold, test_predicted, output_filename=args.expname + '.test.txt')  # evalb
+        def save_model(path):
+            dy.save(path, [parser])
 
-            print(
-                "epoch {:,} "
-                "test-fscore {} "
-                "test-elapsed {} "
-                "total-elapsed {}".format(
-                    epoch,
-                    test_fscore,
-                    format_elapsed(test_start_time),
-                    format_elapsed(start_time),
-                )
-            )
+        try:
+            checkpoint_evaluator.check(epoch, parse_sentences, save_model)
+        finally:
+            if args.eval_workers > 1:
+                remove_model(eval_model_path)
 
 
     train_trees = latent_tree.build_dynamicRBT_trees(train_chunk_insts)
     train_trees = [(x, tree.convert(), chunks, latentscope) for x, tree, chunks, latentscope in train_trees]
 
-    for epoch in itertools.count(start=1):
-        if args.epochs is not None and epoch > args.epochs:
-            break
-
-        np.random.shuffle(train_chunk_insts)
-        epoch_start_time = time.time()
-
-        for start_index in range(0, len(train_chunk_insts), args.batch_size):
-            dy.renew_cg()
-            batch_losses = []
-
-
-            for x, tree, chunks, latentscope in train_trees[start_index:start_index + args.batch_size]:
-
-                discard = False
-                for chunk in chunks:
-                    length = chunk[2] - chunk[1]
-                    if length > args.maxllimit:
-                        discard = True
-                        break
-
-                if discard:
+    averager = None
+    rank = 0
+    if args.train_workers > 1:
+        # Forked after the model and trainer are built, every worker starts from the same parameters.
+        averager = distributed.ParameterAverager(model, args.train_workers)
+        rank = averager.start()
+        np.random.seed([args.numpy_seed, rank])
+
+    train_loader = loader.TrainLoader(
+        train_trees, args.batch_size, args.maxllimit, args.lengthbucket == 1, args.numpy_seed,
+        rank, args.train_workers)
+    if rank == 0:
+        print("Training on {:,} examples, {:,} discarded with a chunk longer than {}.".format(
+            train_loader.kept, train_loader.discarded, args.maxllimit))
+    # With --train-workers the checks happen at the synchronisations, counting the sentences of all workers.
+    check_every = (train_loader.kept if averager is not None else len(train_loader)) / args.checks_per_epoch
+    # Periodic averaging only within the batches every shard has, so all workers average the same number of times.
+    sync_batches = train_loader.get_min_batch_count()
+
+    try:
+        for epoch in itertools.count(start=args.start_epoch):
+            if args.epochs is not None and epoch > args.epochs:
+                break
+
+            epoch_start_time = time.time()
+            epoch_processed = 0
+            epoch_train_seconds = 0.0
+            checked_processed = 0
+
+            start_batch = args.start_batch if epoch == args.start_epoch else 0
+            for batch_number, batch_count, batch in train_loader.epoch(epoch, start_batch):
+                batch_start_time = time.time()
+                dy.renew_cg()
+                batch_losses = []
+                batch_instances = []
+
+                for x, tree, chunks, latentscope in batch:
+                    sentence = [(parse.XX, ch) for ch in x]
+                    if args.train_batching != "sentence":
+                        batch_instances.append((sentence, tree, chunks, latentscope))
+                    elif args.parser_type == "top-down":
+                        _, loss = parser.parse(sentence, tree, args.explore)
+                        batch_losses.append(loss)
+                    else:
+                        _, loss = parser.parse(sentence, tree, chunks, latentscope)
+                        batch_losses.append(loss)
+                    total_processed += 1
+                    current_processed += 1
+                    epoch_processed += 1
+
+                if batch_instances:
+                    batch_losses.extend(
+                        loss for _, loss in parser.train_batch(batch_instances, args.train_batching == "explicit"))
+
+                batch_loss = dy.average(batch_losses)
+                batch_loss_value = batch_loss.scalar_value()
+                batch_loss.backward()
+                trainer.update()
+                synced_processed = None
+                if averager is not None and batch_number % args.sync_every == 0 and batch_number <= sync_batches:
+                    synced_processed = averager.average(epoch_processed)
+                epoch_train_seconds += time.time() - batch_start_time
+
+                if rank > 0:
                     continue
-                    print('discard')
-
-
-                sentence = [(parse.XX, ch) for ch in x]
-                if args.parser_type == "top-down":
-                    _, loss = parser.parse(sentence, tree, args.explore)
-                else:
-                    _, loss = parser.parse(sentence, tree, chunks, latentscope)
-                batch_losses.append(loss)
-                total_processed += 1
-                current_processed += 1
-
-
-            batch_loss = dy.average(batch_losses)
-            batch_loss_value = batch_loss.scalar_value()
-            batch_loss.backward()
-            trainer.update()
-
-            print(
-                "Epoch {:,} "
-                "batch {:,}/{:,} "
-                "processed {:,} "
-                "batch-loss {:.4f} "
-                "epoch-elapsed {} "
-                "total-elapsed {}".format(
-                    epoch,
-                    start_index // args.batch_size + 1,
-                    int(np.ceil(len(train_chunk_insts) / args.batch_size)),
-                    total_processed,
-                    batch_loss_value,
-                    format_elapsed(epoch_start_time),
-                    format_elapsed(start_time),
-                ), flush=True
-            )
+                print(
+                    "Epoch {:,} "
+                    "batch {:,}/{:,} "
+                    "processed {:,} "
+                    "batch-loss {:.4f} "
+                    "sents/sec {:.1f} "
+                    "epoch-elapsed {} "
+                    "total-elapsed {}".format(
+                        epoch,
+                        batch_number,
+                        batch_count,
+                        total_processed,
+                        batch_loss_value,
+                        epoch_processed / epoch_train_seconds,
+                        format_elapsed(epoch_start_time),
+                        format_elapsed(start_time),
+                    ), flush=True
+                )
 
-            if current_processed >= check_every:
-                current_processed -= check_every
-                if epoch > 7:
+                if averager is None and current_processed >= check_every:
+                    current_processed -= check_every
+                    if epoch > 7:
+                        check_dev()
+                elif synced_processed is not None and synced_processed - checked_processed >= check_every:
+                    checked_processed = synced_processed
+                    if epoch > 7:
+                        check_dev()
+
+            if averager is None:
+                print("Epoch {:,} trained {:,} sentences in {:.1f}s, {:.1f} sents/sec".format(
+                    epoch, epoch_processed, epoch_train_seconds,
+                    epoch_processed / epoch_train_seconds if epoch_train_seconds > 0 else 0.0), flush=True)
+                continue
+
+            # Every worker ends the epoch with the same averaged parameters, rank 0 checks them on dev.
+            sync_start_time = time.time()
+            epoch_processed = averager.average(epoch_processed)
+            epoch_train_seconds += time.time() - sync_start_time
+            if rank == 0:
+                sents_per_second = epoch_processed / epoch_train_seconds if epoch_train_seconds > 0 else 0.0
+                scaling = ""
+                if args.baseline_sps is not None:
+                    scaling = ", speedup {:.2f}x, scaling efficiency {:.1f}%".format(
+                        sents_per_second / args.baseline_sps,
+                        sents_per_second / (args.baseline_sps * args.train_workers) * 100)
+                print("Epoch {:,} trained {:,} sentences on {} workers in {:.1f}s, {:.1f} sents/sec{}".format(
+                    epoch, epoch_processed, args.train_workers, epoch_train_seconds, sents_per_second, scaling),
+                    flush=True)
+                if epoch > 7 and epoch_processed > checked_processed:
                     check_dev()
+    except BaseException:
+        if averager is not None:
+            averager.abort()
+        if rank > 0:
+            traceback.print_exc()
+            os._exit(1)
+        raise
+    finally:
+        # Also when training fails, otherwise exiting waits forever for the evaluator to get None.
+        if rank == 0 and args.async_eval:
+            eval_queue.put(None)
+            evaluator_process.join()
+
+    if rank > 0:
+        os._exit(0)
+    if averager is not None and averager.join() > 0:
+        print("Some training workers failed.")
 
 
 def run_test(args):
+    import_dynet()
     #args.test_path = args.test_path.replace('[*]', args.treetype)
     print("Loading test trees from {}...".format(args.test_path))
     test_treebank = trees.load_trees(args.test_path, args.normal)
@@ -363,6 +570,271 @@ def run_test(args):
         )
     )
 
+def build_parse_tokens(parser, normal, batch_size, parse_cache=None, deadline_ms=None):
+    '''
+    :param deadline_ms: time budget of every sentence; the sentences that would not be parsed within it get the
+        fallback decoder and a degraded tree
+    :return: function from a list of token lists to [(tree, chunks)] with the input tokens as words
+    '''
+    def parse_trees(token_lists):
+        sentences = [
+            [(npparser.XX, util.normalize_word(token) if normal == 1 else token) for token in tokens]
+            for tokens in token_lists]
+        engine = npparser if isinstance(parser, npparser.NumpyParser) else parse
+        return [
+            tree.convert()
+            for tree in engine.parse_sentences(parser, sentences, batch_size, report=False,
+                time_budget=None if deadline_ms is None else deadline_ms / 1000)]
+
+    if parse_cache is not None:
+        return cache.CachedParser(parse_trees, parse_cache).parse
+
+    def parse_tokens(token_lists):
+        results = []
+        for tokens, tree in zip(token_lists, parse_trees(token_lists)):
+            tree = cache.replace_words(tree, tokens)
+            results.append((tree, tree.to_chunks()))
+        return results
+
+    return parse_tokens
+
+
+def load_parser(args):
+    print("Loading model from {}...".format(args.model_path_base))
+    if args.engine == "numpy":
+        return npparser.NumpyParser.load(args.model_path_base)
+    import_dynet()
+    model = dy.ParameterCollection()
+    [parser] = dy.load(args.model_path_base, model)
+    return parser
+
+
+def run_parse(args):
+    progress = stream.Progress(args.progress)
+    skip = progress.load() if args.resume else 0
+
+    # Everything but the parses goes to stderr, stdout may be the output.
+    with contextlib.redirect_stdout(sys.stderr):
+        parser = load_parser(args)
+
+    if args.prefix_cache > 0:
+        parser.prefix_cache = prefixcache.PrefixStateCache(args.prefix_cache)
+
+    parse_cache = None
+    if args.cache_size > 0:
+        parse_cache = cache.ParseCache(args.cache_size, args.cache_ttl, args.cache_path, args.normal)
+    parse_tokens = build_parse_tokens(parser, args.normal, args.batch_size, parse_cache, args.deadline_ms)
+
+    if skip > 0:
+        print("Resuming after line {:,}...".format(skip), file=sys.stderr)
+    output = sys.stdout if args.output is None else open(args.output, 'a' if skip > 0 else 'w', encoding='utf-8')
+    format_result = stream.formatters[args.format]
+
+    start_time = time.time()
+    parsed = 0
+    degraded = 0
+    lines_done = skip
+    addresses = stream.read_addresses(args.inputs, skip)
+    for line_number, text, tree, chunks in stream.parse_stream(addresses, parse_tokens, args.buffer_size):
+        output.write(format_result(line_number, text, tree, chunks))
+        parsed += 1
+        if tree is not None and tree.degraded:
+            degraded += 1
+        lines_done = line_number
+        if parsed % args.buffer_size == 0:
+            output.flush()
+            progress.save(lines_done)
+            print(
+                "parsed {:,} "
+                "lines-done {:,} "
+                "elapsed {}".format(parsed, lines_done, format_elapsed(start_time)),
+                file=sys.stderr, flush=True)
+
+    output.flush()
+    progress.save(lines_done)
+    if output is not sys.stdout:
+        output.close()
+
+    print("parsed {:,} addresses in {}".format(parsed, format_elapsed(start_time)), file=sys.stderr)
+    if args.deadline_ms is not None:
+        print("degraded {:,} deadline {}".format(degraded, dict(parser.deadline_decoder.stats())), file=sys.stderr)
+    if parse_cache is not None:
+        print("cache {}".format(dict(parse_cache.stats())), file=sys.stderr)
+        if args.cache_path is not None:
+            parse_cache.save()
+    if getattr(parser, "prefix_cache", None) is not None:
+        print(parser.prefix_cache.report(), file=sys.stderr)
+
+
+def run_serve(args):
+    parser = load_parser(args)
+
+    parse_cache = None
+    if args.cache_size > 0:
+        parse_cache = cache.ParseCache(args.cache_size, args.cache_ttl, normal=args.normal)
+    parse_tokens = build_parse_tokens(parser, args.normal, args.max_batch_size, parse_cache, args.deadline_ms)
+
+    worker_pool = None
+    if args.workers > 1:
+        # Forked after loading, so the workers share the parameters; each one keeps its own parse cache.
+        worker_pool = prefork.ForkedWorkerPool(parse_tokens, args.workers, args.dispatch)
+        parse_tokens = worker_pool.parse_tokens
+        print("Forked {} parse workers ({} dispatch)".format(args.workers, args.dispatch))
+
+    batcher = server.MicroBatcher(parse_tokens, args.max_batch_size, args.max_wait_ms / 1000, max_inflight=max(1, args.workers))
+    try:
+        server.ParseServer(batcher, args.host, args.port, worker_pool).run()
+    finally:
+        if worker_pool is not None:
+            worker_pool.close()
+
+
+def run_export(args):
+    import_dynet()
+    print("Loading model from {}...".format(args.model_path_base))
+    model = dy.ParameterCollection()
+    [parser] = dy.load(args.model_path_base, model)
+
+    output_path = args.output or args.model_path_base + ".npz"
+    npparser.export_model(parser, output_path)
+    print("Exported to {}".format(output_path))
+
+    print("Checking the NumPy engine on {}...".format(args.check_path))
+    numpy_parser = npparser.NumpyParser.load(output_path)
+    check_insts = util.read_chunks(args.check_path, args.normal)[:args.check_sentences]
+    sentences = [[(parse.XX, ch) for ch in x] for x, chunks in check_insts]
+
+    start_time = time.time()
+    dynet_parsed = []
+    for sentence in sentences:
+        dy.renew_cg()
+        tree, score = parser.parse(sentence)
+        dynet_parsed.append((tree, score.value() if isinstance(score, dy.Expression) else score))
+    dynet_elapsed = time.time() - start_time
+
+    start_time = time.time()
+    numpy_parsed = [numpy_parser.parse(sentence) for sentence in sentences]
+    numpy_elapsed = time.time() - start_time
+
+    mismatches = sum(
+        1 for (dynet_tree, _), (numpy_tree, _) in zip(dynet_parsed, numpy_parsed)
+        if dynet_tree.convert().linearize() != numpy_tree.convert().linearize())
+    max_score_diff = max(
+        [abs(dynet_score - numpy_score) for (_, dynet_score), (_, numpy_score) in zip(dynet_parsed, numpy_parsed)] or [0.0])
+    print(
+        "sentences {:,} "
+        "tree-mismatches {:,} "
+        "max-score-diff {:.2e} "
+        "dynet-sents/sec {:.1f} "
+        "numpy-sents/sec {:.1f}".format(
+            len(sentences), mismatches, max_score_diff,
+            len(sentences) / max(dynet_elapsed, 1e-9), len(sentences) / max(numpy_elapsed, 1e-9)))
+
+
+def run_quantize(args):
+    print("Loading model from {}...".format(args.model_path))
+    with np.load(args.model_path) as arrays:
+        arrays = {name: arrays[name] for name in arrays.files}
+    output_path = args.output or "{}.{}.npz".format(args.model_path[:-len(".npz")] if args.model_path.endswith(".npz") else args.model_path, args.dtype)
+    np.savez(output_path, **npparser.quantize_arrays(arrays, args.dtype))
+    print("Quantized ({}) model saved to {}".format(args.dtype, output_path))
+
+    dev_chunk_insts = util.read_chunks(args.dev_path, args.normal)
+    dev_sentences = [[(npparser.XX, ch) for ch in x] for x, chunks in dev_chunk_insts]
+    gold_chunks = [util.inst2chunks(inst) for inst in dev_chunk_insts]
+
+    # The quantised matrices stay quantised in memory, so weight-mb is what parsing holds and reads.
+    results = []
+    for name, parser, path in (
+            ("float32", npparser.NumpyParser(arrays), args.model_path),
+            (args.dtype, npparser.NumpyParser.load(output_path), output_path)):
+        start_time = time.time()
+        predicted = npparser.parse_sentences(parser, dev_sentences, args.batch_size, report=False)
+        elapsed = time.time() - start_time
+        pred_chunks = [tree.convert().to_chunks() for tree in predicted]
+        fscore = evaluate.chunk_fscore(gold_chunks, pred_chunks)
+        results.append((pred_chunks, fscore.fscore))
+        print(
+            "{} "
+            "dev-fscore {} "
+            "weight-mb {:.2f} "
+            "file-mb {:.2f} "
+            "sents/sec {:.1f}".format(
+                name, fscore, parser.weight_bytes() / 2 ** 20, os.path.getsize(path) / 2 ** 20,
+                len(dev_sentences) / max(elapsed, 1e-9)))
+
+    (float_chunks, float_f1), (quantized_chunks, quantized_f1) = results
+    agreement = sum(1 for a, b in zip(float_chunks, quantized_chunks) if a == b)
+    print(
+        "dev-fscore-drift {:+.2f} "
+        "identical-chunkings {:,}/{:,}".format(
+            (quantized_f1 - float_f1) * 100, agreement, len(dev_sentences)))
+
+
+def run_check_tokenize(args):
+    insts = util.read_chunks(args.path, 0)
+    mismatches = util.get_tokenize_mismatches(insts)
+    for x in mismatches[:args.show]:
+        print("{} -> {}".format(' '.join(x), ' '.join(util.tokenize_address(''.join(x)))))
+    print("{:,} of {:,} addresses tokenize differently from {}".format(len(mismatches), len(insts), args.path))
+
+
+def run_compare(args):
+    parser = load_parser(args)
+    label_max_lengths = parser.label_max_lengths if args.engine == "numpy" else parser.get_label_max_lengths()
+    chunk_label_indices = chart.get_chunk_label_indices(parser.label_vocab)
+
+    def decode_chart(sentence, label_scores):
+        label_indices, splits, branchings, _ = chart.decode(label_scores, label_max_lengths)
+        tree, _ = chart.backtrack(sentence, parser.label_vocab, label_indices, splits, branchings)
+        return tree.convert().to_chunks()
+
+    def decode_segment(sentence, label_scores):
+        segments, _ = chart.segment(label_scores, chunk_label_indices, args.max_chunk_length, label_max_lengths)
+        return chart.segments_to_chunks(sentence, parser.label_vocab, segments)
+
+    right_branching_labels = latent.latent_tree_builder(
+        parser.label_vocab, args.RBTlabel, args.nontlabelstyle).get_right_branching_labels()
+
+    def decode_constrained(sentence, label_scores):
+        label_indices, splits, branchings, _ = chart.decode(label_scores, label_max_lengths, right_branching_labels)
+        tree, _ = chart.backtrack(sentence, parser.label_vocab, label_indices, splits, branchings)
+        return tree.convert().to_chunks()
+
+    decoders = [("chart", decode_chart), ("segment", decode_segment), ("constrained", decode_constrained)]
+
+    for name, path in (("dev", args.dev_path), ("test", args.test_path)):
+        chunk_insts = util.read_chunks(path, args.normal)
+        sentences = [[(npparser.XX, ch) for ch in x] for x, chunks in chunk_insts]
+        gold_chunks = [util.inst2chunks(inst) for inst in chunk_insts]
+
+        # The label scores are computed once and shared, only the decoders are timed.
+        start_time = time.time()
+        label_scores = []
+        for batch in stream.batched(sentences, args.batch_size):
+            if args.engine == "dynet":
+                dy.renew_cg()
+            label_scores.extend(parser.get_label_scores_batch(batch))
+        print("{} sentences {:,} scoring-sec {:.2f}".format(name, len(sentences), time.time() - start_time))
+
+        predicted = {}
+        for decoder_name, decode in decoders:
+            start_time = time.time()
+            predicted[decoder_name] = [decode(sentence, scores) for sentence, scores in zip(sentences, label_scores)]
+            elapsed = time.time() - start_time
+            print(
+                "{} {} "
+                "fscore {} "
+                "decode-sec {:.3f} "
+                "ms/sent {:.3f}".format(
+                    name, decoder_name, evaluate.chunk_fscore(gold_chunks, predicted[decoder_name]),
+                    elapsed, 1000 * elapsed / max(len(sentences), 1)))
+
+        for decoder_name, _ in decoders[1:]:
+            agreement = evaluate.chunk_fscore(predicted["chart"], predicted[decoder_name])
+            print("{} {} chunk-agreement-with-chart {:.2f}%".format(name, decoder_name, agreement.fscore * 100))
+
+
 def main():
     dynet_args = [
         "--dynet-mem",
@@ -412,7 +884,21 @@ def main():
     subparser.add_argument("--zerocostchunk", type=int, default=0)
     subparser.add_argument("--loadmodel", type=str, default="none")
     subparser.add_argument("--trainc", type=int, default=1)
+    subparser.add_argument("--decodec", type=int, default=0)
     subparser.add_argument("--maxllimit", type=int, default=38)
+    subparser.add_argument("--spanbatch", type=int, default=0)
+    subparser.add_argument("--decoder", choices=["dynet", "numpy"], default="dynet")
+    subparser.add_argument("--eval-batch-size", type=int, default=1)
+    subparser.add_argument("--eval-workers", type=int, default=1)
+    subparser.add_argument("--async-eval", action="store_true")
+    subparser.add_argument("--chunkbound", type=int, default=0)
+    subparser.add_argument("--train-batching", choices=["sentence", "autobatch", "explicit"], default="sentence")
+    subparser.add_argument("--lengthbucket", type=int, default=0)
+    subparser.add_argument("--start-epoch", type=int, default=1)
+    subparser.add_argument("--start-batch", type=int, default=0)
+    subparser.add_argument("--train-workers", type=int, default=1)
+    subparser.add_argument("--sync-every", type=int, default=10)
+    subparser.add_argument("--baseline-sps", type=float)
 
 
     subparser = subparsers.add_parser("test")
@@ -427,7 +913,91 @@ def main():
     subparser.add_argument("--normal", type=int, default=1)
 
 
+    subparser = subparsers.add_parser("parse")
+    subparser.set_defaults(callback=run_parse)
+    for arg in dynet_args:
+        subparser.add_argument(arg)
+    subparser.add_argument("inputs", nargs="*")
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--output")
+    subparser.add_argument("--format", choices=["jsonl", "bio"], default="jsonl")
+    subparser.add_argument("--normal", type=int, default=1)
+    subparser.add_argument("--batch-size", type=int, default=1)
+    subparser.add_argument("--buffer-size", type=int, default=1000)
+    subparser.add_argument("--progress")
+    subparser.add_argument("--resume", action="store_true")
+    subparser.add_argument("--cache-size", type=int, default=0)
+    subparser.add_argument("--cache-ttl", type=float)
+    subparser.add_argument("--cache-path")
+    subparser.add_argument("--prefix-cache", type=int, default=0)
+    subparser.add_argument("--engine", choices=["dynet", "numpy"], default="dynet")
+    subparser.add_argument("--deadline-ms", type=float)
+
+
+    subparser = subparsers.add_parser("serve")
+    subparser.set_defaults(callback=run_serve)
+    for arg in dynet_args:
+        subparser.add_argument(arg)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--host", default="127.0.0.1")
+    subparser.add_argument("--port", type=int, default=8080)
+    subparser.add_argument("--normal", type=int, default=1)
+    subparser.add_argument("--max-batch-size", type=int, default=32)
+    subparser.add_argument("--max-wait-ms", type=float, default=5)
+    subparser.add_argument("--cache-size", type=int, default=0)
+    subparser.add_argument("--cache-ttl", type=float)
+    subparser.add_argument("--workers", type=int, default=1)
+    subparser.add_argument("--dispatch", choices=["least-loaded", "round-robin"], default="least-loaded")
+    subparser.add_argument("--engine", choices=["dynet", "numpy"], default="dynet")
+    subparser.add_argument("--deadline-ms", type=float)
+
+
+    subparser = subparsers.add_parser("export")
+    subparser.set_defaults(callback=run_export)
+    for arg in dynet_args:
+        subparser.add_argument(arg)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--output")
+    subparser.add_argument("--check-path", default="data/dev.txt")
+    subparser.add_argument("--check-sentences", type=int, default=200)
+    subparser.add_argument("--normal", type=int, default=1)
+
+
+    subparser = subparsers.add_parser("compare")
+    subparser.set_defaults(callback=run_compare)
+    for arg in dynet_args:
+        subparser.add_argument(arg)
+    subparser.add_argument("--model-path-base", required=True)
+    subparser.add_argument("--engine", choices=["dynet", "numpy"], default="dynet")
+    subparser.add_argument("--dev-path", default="data/dev.txt")
+    subparser.add_argument("--test-path", default="data/test.txt")
+    subparser.add_argument("--normal", type=int, default=1)
+    subparser.add_argument("--batch-size", type=int, default=32)
+    subparser.add_argument("--max-chunk-length", type=int)
+    subparser.add_argument("--RBTlabel", type=str, default="city")
+    subparser.add_argument("--nontlabelstyle", type=int, default=0)
+
+
+    subparser = subparsers.add_parser("quantize")
+    subparser.set_defaults(callback=run_quantize)
+    subparser.add_argument("--model-path", required=True)
+    subparser.add_argument("--output")
+    subparser.add_argument("--dtype", choices=["int8", "float16"], default="int8")
+    subparser.add_argument("--dev-path", default="data/dev.txt")
+    subparser.add_argument("--normal", type=int, default=1)
+    subparser.add_argument("--batch-size", type=int, default=32)
+
+
+    subparser = subparsers.add_parser("check-tokenize")
+    subparser.set_defaults(callback=run_check_tokenize)
+    subparser.add_argument("--path", default="data/dev.txt")
+    subparser.add_argument("--show", type=int, default=10)
+
+
     args = parser.parse_args()
+    # The LSTM states are only cached by the DyNet parser on one sentence at a time.
+    if args.callback is run_parse and args.prefix_cache > 0 and (args.engine != "dynet" or args.batch_size > 1):
+        parser.error("--prefix-cache requires --engine dynet and --batch-size 1")
     args.callback(args)
 
 if __name__ == "__main__":
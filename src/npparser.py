@@ -0,0 +1,422 @@
+import time
+
+import numpy as np
+
+import chart
+import scheduler
+import vocabulary
+
+
+START = "<START>"
+STOP = "<STOP>"
+UNK = "</s>"
+XX = "XX"
+
+# DyNet's VanillaLSTMBuilder adds this constant to the forget gate pre-activation.
+FORGET_BIAS = 1.0
+# Elements of a quantised matrix cast to float32 at a time by linear.
+LINEAR_BLOCK_SIZE = 1 << 16
+
+
+def vocab_to_arrays(vocab):
+    values = ["\t".join(value) if isinstance(value, tuple) else value for value in vocab.values]
+    counts = [vocab.count(value) for value in vocab.values]
+    return np.array(values, dtype=np.str_), np.array(counts, dtype=np.int64)
+
+
+def arrays_to_vocab(values, counts, tuples=False):
+    vocab = vocabulary.Vocabulary()
+    for value, count in zip(values.tolist(), counts.tolist()):
+        if tuples:
+            value = tuple(value.split("\t")) if value else ()
+        vocab.index(value)
+        vocab.counts[value] = count
+    vocab.freeze()
+    return vocab
+
+
+def export_model(parser, path, forget_bias=FORGET_BIAS):
+    '''
+    Writes the inference weights and vocabularies of a ChartDynamicRBTConstraintParser to an .npz file that
+    NumpyParser.load reads without DyNet.
+    '''
+    if parser.chunk_encoding == 2:
+        raise ValueError("chunk encoding 2 (chunk LSTM span encoding) is not supported by the NumPy engine")
+
+    arrays = {
+        "lstm_dim": np.array(parser.lstm_dim),
+        "lstm_layers": np.array(len(parser.lstm.builder_layers)),
+        "forget_bias": np.array(forget_bias, dtype=np.float32),
+        "tag_embeddings": parser.tag_embeddings.as_array(),
+        "word_embeddings": parser.word_embeddings.as_array(),
+        "label_layers": np.array(len(parser.f_label.weights)),
+    }
+    for layer, builders in enumerate(parser.lstm.builder_layers):
+        for direction, builder in zip(("forward", "backward"), builders):
+            # VanillaLSTMBuilder parameters: Wx (4h x input), Wh (4h x h), b (4h), gates ordered i, f, o, g.
+            [[weight_x, weight_h, bias]] = builder.get_parameters()
+            prefix = "lstm_{}_{}_".format(layer, direction)
+            arrays[prefix + "wx"] = weight_x.as_array()
+            arrays[prefix + "wh"] = weight_h.as_array()
+            arrays[prefix + "b"] = bias.as_array()
+    for layer, (weight, bias) in enumerate(zip(parser.f_label.weights, parser.f_label.biases)):
+        arrays["label_{}_w".format(layer)] = weight.as_array()
+        arrays["label_{}_b".format(layer)] = bias.as_array()
+
+    for name, vocab in (("tag", parser.tag_vocab), ("word", parser.word_vocab), ("label", parser.label_vocab)):
+        arrays[name + "_values"], arrays[name + "_counts"] = vocab_to_arrays(vocab)
+
+    label_max_lengths = parser.get_label_max_lengths()
+    if label_max_lengths is not None:
+        arrays["label_max_lengths"] = label_max_lengths
+    if parser.right_branching_labels is not None:
+        arrays["right_branching_labels"] = parser.right_branching_labels
+
+    np.savez(path, **{name: np.asarray(value) for name, value in arrays.items()})
+
+
+def get_matrix_names(arrays):
+    '''
+    :return: names of the LSTM gate and label MLP weight matrices, the arrays quantize_arrays compresses
+    '''
+    return sorted(
+        name for name in arrays
+        if (name.startswith("lstm_") and name.endswith(("_wx", "_wh"))) or
+           (name.startswith("label_") and name.endswith("_w")))
+
+
+def quantize_arrays(arrays, dtype):
+    '''
+    :param dtype: "float16", or "int8" for symmetric int8 matrices with one float32 scale per row (per gate
+        unit of the LSTM, per output unit of f_label) stored as <name>_scale
+    :return: a copy of the exported arrays with the weight matrices quantised
+    '''
+    quantized = dict(arrays)
+    quantized["quantization"] = np.array(dtype)
+    for name in get_matrix_names(arrays):
+        weight = arrays[name].astype(np.float32)
+        if dtype == "float16":
+            quantized[name] = weight.astype(np.float16)
+        elif dtype == "int8":
+            scale = np.abs(weight).max(axis=1) / 127
+            scale[scale == 0] = 1
+            quantized[name] = np.round(weight / scale[:, None]).astype(np.int8)
+            quantized[name + "_scale"] = scale.astype(np.float32)
+        else:
+            raise ValueError("Unknown quantization: {}".format(dtype))
+    return quantized
+
+
+def linear(x, weight, scale):
+    '''
+    x @ weight.T for a float32, float16 or int8 weight, scale is None unless int8. A quantised weight stays
+    quantised: it is cast to float32 a block of rows at a time, so at most LINEAR_BLOCK_SIZE float32 weights
+    exist at once, and the per-row scale of an int8 weight is applied to the output.
+    '''
+    if weight.dtype == np.float32:
+        y = x @ weight.T
+    else:
+        y = np.empty(x.shape[:-1] + (weight.shape[0],), dtype=np.float32)
+        block_rows = max(1, LINEAR_BLOCK_SIZE // weight.shape[1])
+        for start in range(0, weight.shape[0], block_rows):
+            y[..., start:start + block_rows] = x @ weight[start:start + block_rows].T.astype(np.float32)
+    return y if scale is None else y * scale
+
+
+def sigmoid(x):
+    return 0.5 * (np.tanh(0.5 * x) + 1)
+
+
+class NumpyParser(object):
+    '''
+    Inference-only ChartDynamicRBTConstraintParser on NumPy arrays: the character BiLSTM, the span
+    differences of get_span_encoding, f_label and chart.decode, vectorised over a minibatch of sentences.
+    It gives the same trees as the DyNet parser up to float rounding.
+    '''
+
+    def __init__(self, arrays):
+        self.lstm_dim = int(arrays["lstm_dim"])
+        self.forget_bias = float(arrays["forget_bias"])
+        self.tag_embeddings = arrays["tag_embeddings"]
+        self.word_embeddings = arrays["word_embeddings"]
+        self.tag_vocab = arrays_to_vocab(arrays["tag_values"], arrays["tag_counts"])
+        self.word_vocab = arrays_to_vocab(arrays["word_values"], arrays["word_counts"])
+        self.label_vocab = arrays_to_vocab(arrays["label_values"], arrays["label_counts"], tuples=True)
+        self.label_max_lengths = arrays.get("label_max_lengths")
+        self.right_branching_labels = arrays.get("right_branching_labels")
+        self.quantization = str(arrays["quantization"]) if "quantization" in arrays else "float32"
+        self.deadline_decoder = chart.DeadlineDecoder(
+            self.label_vocab, self.label_max_lengths, self.right_branching_labels)
+
+        # Quantised matrices are kept as they are in memory, linear casts them block by block.
+        def matrix(name):
+            return arrays[name], arrays.get(name + "_scale")
+
+        # LSTM weights are (weight_x, scale_x, weight_h, scale_h, bias), scales are None unless int8.
+        self.lstm = []
+        for layer in range(int(arrays["lstm_layers"])):
+            directions = []
+            for direction in ("forward", "backward"):
+                prefix = "lstm_{}_{}_".format(layer, direction)
+                directions.append(matrix(prefix + "wx") + matrix(prefix + "wh") + (arrays[prefix + "b"],))
+            self.lstm.append(directions)
+        self.label_layers = [
+            matrix("label_{}_w".format(layer)) + (arrays["label_{}_b".format(layer)],)
+            for layer in range(int(arrays["label_layers"]))]
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls({name: arrays[name] for name in arrays.files})
+
+    def weight_bytes(self):
+        '''
+        :return: bytes of the embeddings, LSTM and f_label parameters held in memory
+        '''
+        arrays = [self.tag_embeddings, self.word_embeddings]
+        for directions in self.lstm:
+            for weights in directions:
+                arrays.extend(weights)
+        for weights in self.label_layers:
+            arrays.extend(weights)
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def get_word_index(self, word):
+        if word in (START, STOP) or self.word_vocab.count(word):
+            return self.word_vocab.index(word)
+        return self.word_vocab.index(UNK)
+
+    def get_embedding_indices(self, sentence):
+        tag_indices, word_indices = [], []
+        for tag, word in [(START, START)] + sentence + [(STOP, STOP)]:
+            tag_indices.append(self.tag_vocab.index(tag))
+            word_indices.append(self.get_word_index(word))
+        return tag_indices, word_indices
+
+    def embed(self, tag, word):
+        return np.concatenate([
+            self.tag_embeddings[self.tag_vocab.index(tag)], self.word_embeddings[self.get_word_index(word)]])
+
+    def run_lstm(self, inputs, weights, initial_state=None):
+        '''
+        :param inputs: steps x batch x input_dim
+        :param initial_state: (c, h) batch x lstm_dim arrays, zeros if None
+        :return: steps x batch x lstm_dim hidden states and the final (c, h)
+        '''
+        weight_x, scale_x, weight_h, scale_h, bias = weights
+        dim = weight_h.shape[1]
+        projected = linear(inputs, weight_x, scale_x) + bias
+        projected[:, :, dim:2 * dim] += self.forget_bias
+        if initial_state is None:
+            c = np.zeros((inputs.shape[1], dim), dtype=np.float32)
+            h = np.zeros((inputs.shape[1], dim), dtype=np.float32)
+        else:
+            c, h = initial_state
+        outputs = np.empty((inputs.shape[0], inputs.shape[1], dim), dtype=np.float32)
+        for t in range(inputs.shape[0]):
+            gates = projected[t] + linear(h, weight_h, scale_h)
+            c = sigmoid(gates[:, dim:2 * dim]) * c + sigmoid(gates[:, :dim]) * np.tanh(gates[:, 3 * dim:])
+            h = sigmoid(gates[:, 2 * dim:3 * dim]) * np.tanh(c)
+            outputs[t] = h
+        return outputs, (c, h)
+
+    def transduce(self, embeddings, lengths, first_forward=None):
+        '''
+        BiLSTM over a padded minibatch as parse.ChartDynamicRBTConstraintParser.transduce_batch.
+
+        :param embeddings: steps x batch x input_dim, sentences padded with STOP at the end
+        :param first_forward: outputs of the first forward layer if they are already known
+        '''
+        steps = embeddings.shape[0]
+        # reverse_positions[t, i] is the position read at step t of the backward pass of sentence i: each
+        # sentence is reversed from its own STOP, the padding stays in place.
+        positions = np.arange(steps)[:, None]
+        last = np.array(lengths)[None, :] + 1
+        reverse_positions = np.where(positions <= last, last - positions, positions)
+        batch = np.arange(embeddings.shape[1])[None, :]
+
+        outputs = embeddings
+        for layer, (forward_weights, backward_weights) in enumerate(self.lstm):
+            if layer == 0 and first_forward is not None:
+                forward = first_forward
+            else:
+                forward, _ = self.run_lstm(outputs, forward_weights)
+            backward, _ = self.run_lstm(outputs[reverse_positions, batch], backward_weights)
+            outputs = np.concatenate([forward, backward[reverse_positions, batch]], axis=2)
+        return outputs
+
+    def get_span_scores(self, lstm_outputs, length):
+        '''
+        :param lstm_outputs: steps x batch x 2 lstm_dim
+        :return: labels x spans x batch scores, the spans ordered as in chart.get_spans(length)
+        '''
+        lefts, rights = chart.get_span_positions(length)
+
+        # The first layer is linear in the span differences, so it projects every position once and a span
+        # takes the difference of its projected boundaries: O(n) matrix products instead of O(n^2).
+        weight, scale, bias = self.label_layers[0]
+        forward = linear(lstm_outputs[:, :, :self.lstm_dim], weight[:, :self.lstm_dim], scale)
+        backward = linear(lstm_outputs[:, :, self.lstm_dim:], weight[:, self.lstm_dim:], scale)
+        x = forward[rights] - forward[lefts] + backward[lefts + 1] - backward[rights + 1] + bias
+
+        for weight, scale, bias in self.label_layers[1:]:
+            x = linear(np.maximum(x, 0), weight, scale) + bias
+        span_scores = np.concatenate([np.zeros(x.shape[:2] + (1,), dtype=x.dtype), x], axis=2)
+        return span_scores.transpose(2, 0, 1)
+
+    def get_label_scores_batch(self, sentences):
+        '''
+        :return: the (length + 1) x (length + 1) x labels chart of label scores of every sentence
+        '''
+        lengths = [len(sentence) for sentence in sentences]
+        max_length = max(lengths)
+        stop_tag, stop_word = self.tag_vocab.index(STOP), self.word_vocab.index(STOP)
+
+        tag_indices = np.full((max_length + 2, len(sentences)), stop_tag, dtype=np.int64)
+        word_indices = np.full((max_length + 2, len(sentences)), stop_word, dtype=np.int64)
+        for i, sentence in enumerate(sentences):
+            tags, words = self.get_embedding_indices(sentence)
+            tag_indices[:len(tags), i] = tags
+            word_indices[:len(words), i] = words
+        embeddings = np.concatenate(
+            [self.tag_embeddings[tag_indices], self.word_embeddings[word_indices]], axis=2)
+
+        span_scores = self.get_span_scores(self.transduce(embeddings, lengths), max_length)
+        return [chart.to_chart(span_scores[:, :, i], length, max_length) for i, length in enumerate(lengths)]
+
+    def parse_batch(self, sentences, time_budget=None):
+        '''
+        :param time_budget: see parse.ChartDynamicRBTConstraintParser.parse_batch
+        :return: [(tree, score)] in the order of sentences
+        '''
+        start_time = time.time()
+        return [
+            self.deadline_decoder.decode(sentence, label_scores, time_budget, start_time)
+            for sentence, label_scores in zip(sentences, self.get_label_scores_batch(sentences))]
+
+    def parse(self, sentence, time_budget=None):
+        [(tree, score)] = self.parse_batch([sentence], time_budget)
+        return tree, score
+
+    def kbest_batch(self, sentences, k):
+        '''
+        :return: for every sentence up to k [(tree, score, chunks)] with distinct trees, best first
+        '''
+        return [
+            [(tree, score, tree.convert().to_chunks())
+             for tree, score in chart.kbest(
+                 sentence, self.label_vocab, label_scores, k, self.label_max_lengths,
+                 right_branching_labels=self.right_branching_labels)]
+            for sentence, label_scores in zip(sentences, self.get_label_scores_batch(sentences))]
+
+    def segment_batch(self, sentences, max_length=None):
+        '''
+        :return: [(chunks, score)] of the semi-Markov chunk decoder, see chart.segment
+        '''
+        chunk_label_indices = chart.get_chunk_label_indices(self.label_vocab)
+        segmented = []
+        for sentence, label_scores in zip(sentences, self.get_label_scores_batch(sentences)):
+            segments, score = chart.segment(label_scores, chunk_label_indices, max_length, self.label_max_lengths)
+            segmented.append((chart.segments_to_chunks(sentence, self.label_vocab, segments), score))
+        return segmented
+
+
+class ParseSession(object):
+    '''
+    Type-ahead parsing of an address typed one character at a time.
+
+    The embeddings and first-layer forward LSTM states depend on the prefix only and are kept per position,
+    so append and backspace cost one LSTM step each. Every other state changes with the new right boundary:
+    the backward LSTMs read the sentence from its end and the second layer reads the backward states, so the
+    label scores of all spans, not only those touching the boundary, change on every keystroke, and so do
+    all the cells of the chart: neither can be kept from the previous keystroke. parse() therefore costs, per
+    keystroke on n characters, O(n) LSTM steps, O(n^2) span scores (one f_label product per span) and a
+    chart decode of O(n^2 * max_chunk_length). The decode would be O(n^3) without chunk length limits, so a
+    parser exported without them is decoded with max_chunk_length for every label.
+    '''
+
+    def __init__(self, parser, max_chunk_length=38):
+        '''
+        :param max_chunk_length: longest chunk of a parser without chunk length limits, by default the
+            longest chunk training keeps (--maxllimit)
+        '''
+        self.parser = parser
+        self.label_max_lengths = parser.label_max_lengths
+        if self.label_max_lengths is None:
+            self.label_max_lengths = np.full(len(parser.label_vocab.values), max_chunk_length, dtype=np.int64)
+        self.words = []
+        self.embeddings = []
+        self.forward_outputs = []
+        self.forward_states = []
+        self.push(START, START)
+
+    def push(self, tag, word):
+        embedding = self.parser.embed(tag, word)
+        state = self.forward_states[-1] if self.forward_states else None
+        output, state = self.parser.run_lstm(embedding[None, None, :], self.parser.lstm[0][0], state)
+        self.embeddings.append(embedding)
+        self.forward_outputs.append(output[0, 0])
+        self.forward_states.append(state)
+
+    def append(self, words):
+        for word in words:
+            self.words.append(word)
+            self.push(XX, word)
+
+    def backspace(self, count=1):
+        count = min(count, len(self.words))
+        if count > 0:
+            del self.words[-count:]
+            del self.embeddings[-count:]
+            del self.forward_outputs[-count:]
+            del self.forward_states[-count:]
+
+    def reset(self):
+        self.backspace(len(self.words))
+
+    @property
+    def sentence(self):
+        return [(XX, word) for word in self.words]
+
+    def get_label_scores(self):
+        stop = self.parser.embed(STOP, STOP)
+        stop_output, _ = self.parser.run_lstm(stop[None, None, :], self.parser.lstm[0][0], self.forward_states[-1])
+        embeddings = np.array(self.embeddings + [stop])[:, None, :]
+        first_forward = np.concatenate([np.array(self.forward_outputs)[:, None, :], stop_output])
+        length = len(self.words)
+        lstm_outputs = self.parser.transduce(embeddings, [length], first_forward)
+        return chart.to_chart(self.parser.get_span_scores(lstm_outputs, length)[:, :, 0], length)
+
+    def parse(self):
+        '''
+        :return: (tree, score) of the current text, (None, 0.0) when it is empty
+        '''
+        if not self.words:
+            return None, 0.0
+        label_indices, splits, branchings, score = chart.decode(
+            self.get_label_scores(), self.label_max_lengths, self.parser.right_branching_labels)
+        tree, _ = chart.backtrack(self.sentence, self.parser.label_vocab, label_indices, splits, branchings)
+        return tree, score
+
+    def segment(self, max_length=None):
+        if not self.words:
+            return [], 0.0
+        chunk_label_indices = chart.get_chunk_label_indices(self.parser.label_vocab)
+        segments, score = chart.segment(
+            self.get_label_scores(), chunk_label_indices, max_length, self.label_max_lengths)
+        return chart.segments_to_chunks(self.sentence, self.parser.label_vocab, segments), score
+
+
+def parse_sentences(parser, sentences, batch_size=1, report=True, time_budget=None):
+    '''
+    NumpyParser counterpart of parse.parse_sentences.
+    '''
+    if batch_size == 1:
+        return [parser.parse(sentence, time_budget)[0] for sentence in sentences]
+
+    bucket_scheduler = scheduler.BucketScheduler(
+        lambda batch: parser.parse_batch(batch, time_budget), max_batch_size=batch_size)
+    predicted = [tree for tree, _ in bucket_scheduler.parse(sentences)]
+    if report:
+        print(bucket_scheduler.report())
+    return predicted
@@ -0,0 +1,35 @@
+import multiprocessing
+
+import dynet as dy
+
+import parse
+
+
+_parser = None
+_batch_size = 1
+
+
+def init_eval_worker(model_path, batch_size):
+    global _parser, _batch_size
+    model = dy.ParameterCollection()
+    [_parser] = dy.load(model_path, model)
+    _batch_size = batch_size
+
+
+def parse_shard(sentences):
+    return parse.parse_sentences(_parser, sentences, _batch_size, report=False)
+
+
+def parse_sentences(model_path, sentences, workers, batch_size=1, shards_per_worker=4):
+    '''
+    Parses sentences with a pool of worker processes that each load the model saved at model_path once.
+    Contiguous shards keep the predictions in input order.
+    '''
+    shard_size = max(1, -(-len(sentences) // (workers * shards_per_worker)))
+    shards = [sentences[i:i + shard_size] for i in range(0, len(sentences), shard_size)]
+
+    # DyNet keeps one global computation graph per process, spawn gives every worker a fresh one.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=init_eval_worker, initargs=(model_path, batch_size)) as pool:
+        results = pool.map(parse_shard, shards)
+    return [tree for shard in results for tree in shard]
@@ -1,10 +1,12 @@
 import functools
+import time
 
 import dynet as dy
 import numpy as np
 
-import trees
-import util
+import chart
+import latent
+import scheduler
 
 
 START = "<START>"
@@ -24,6 +26,49 @@ def augment(scores, oracle_index):
     return scores + dy.inputVector(increment)
 
 
+@functools.lru_cache(maxsize=128)
+def get_span_selectors(length):
+    # Column i of forward/backward picks lstm_outputs[right] - lstm_outputs[left]
+    # and lstm_outputs[left + 1] - lstm_outputs[right + 1] for the i-th span.
+    spans = chart.get_spans(length)
+    forward = np.zeros((length + 2, len(spans)))
+    backward = np.zeros((length + 2, len(spans)))
+    for i, (left, right) in enumerate(spans):
+        forward[right, i] += 1
+        forward[left, i] -= 1
+        backward[left + 1, i] += 1
+        backward[right + 1, i] -= 1
+    return forward, backward
+
+
+@functools.lru_cache(maxsize=128)
+def get_span_index(length):
+    return {span: i for i, span in enumerate(chart.get_spans(length))}
+
+
+def parse_sentences(parser, sentences, batch_size=1, report=True, time_budget=None):
+    '''
+    :param time_budget: seconds every sentence may take from when the parser starts on it; the sentences whose
+        chart would take longer are parsed by the fallback decoder and their tree has degraded set
+    '''
+    if batch_size == 1:
+        predicted = []
+        for sentence in sentences:
+            dy.renew_cg()
+            tree, _ = parser.parse(sentence, time_budget=time_budget)
+            predicted.append(tree)
+        return predicted
+
+    def parse_batch(batch):
+        dy.renew_cg()
+        return parser.parse_batch(batch, time_budget)
+
+    bucket_scheduler = scheduler.BucketScheduler(parse_batch, max_batch_size=batch_size)
+    predicted = [tree for tree, _ in bucket_scheduler.parse(sentences)]
+    if report:
+        print(bucket_scheduler.report())
+    return predicted
+
 
 class Feedforward(object):
     def __init__(self, model, input_dim, hidden_dims, output_dim):
@@ -76,6 +121,10 @@ class ChartDynamicRBTConstraintParser(object):
             decode_constraint = True,
             zerocostchunk = 0,
             nontlabelstyle = 0,
+            span_batch = False,
+            decoder = "dynet",
+            chunk_length_limits = None,
+            RBTlabel = None,
     ):
         self.spec = locals()
         self.spec.pop("self")
@@ -121,6 +170,16 @@ class ChartDynamicRBTConstraintParser(object):
         self.decode_constraint = decode_constraint
         self.zerocostchunk = zerocostchunk
         self.nontlabelstyle = nontlabelstyle
+        self.span_batch = span_batch
+        self.decoder = decoder
+        self.chunk_length_limits = chunk_length_limits
+        self.RBTlabel = RBTlabel
+        # Optional prefixcache.PrefixStateCache used by parse() at inference, not part of the model.
+        self.prefix_cache = None
+        self.right_branching_labels = self.get_right_branching_labels()
+        self.latent_labels = self.get_latent_labels()
+        self.deadline_decoder = chart.DeadlineDecoder(
+            label_vocab, self.get_label_max_lengths(), self.right_branching_labels)
 
     def param_collection(self):
         return self.model
@@ -130,27 +189,323 @@ class ChartDynamicRBTConstraintParser(object):
         return cls(model, **spec)
 
 
+    def get_label_max_lengths(self):
+        '''
+        :return: longest chunk allowed for every label index by chunk_length_limits, None for exhaustive search
+        '''
+        if not self.chunk_length_limits:
+            return None
+        default = max(self.chunk_length_limits.values())
+        return np.array([
+            self.chunk_length_limits.get(label[0], default) if label else default
+            for label in self.label_vocab.values])
+
+
+    def get_right_branching_labels(self):
+        '''
+        :return: the labels whose spans are only searched right branching when decoding, None without
+            decode_constraint or RBTlabel
+        '''
+        if not self.decode_constraint or self.RBTlabel is None:
+            return None
+        return latent.latent_tree_builder(self.label_vocab, self.RBTlabel, self.nontlabelstyle).get_right_branching_labels()
+
+
+    def get_latent_labels(self):
+        '''
+        :return: boolean array over the labels, the labels whose spans the oracle may branch either way in latentscope
+        '''
+        return np.array([
+            len(label) > 0 and (label[0].endswith("'") or label[0] == EMPTY) for label in self.label_vocab.values])
+
+
+    def get_oracle_label_indices(self, gold, length):
+        '''
+        :return: (length + 1) x (length + 1) array of the oracle label index of every span
+        '''
+        oracle_label_indices = np.zeros((length + 1, length + 1), dtype=np.int64)
+        for left, right in set(gold.oracle_spans()):
+            oracle_label_indices[left, right] = self.label_vocab.index(gold.oracle_label(left, right))
+        return oracle_label_indices
+
+
+    def get_embedding_indices(self, sentence, is_train):
+        indices = []
+        for tag, word in [(START, START)] + sentence + [(STOP, STOP)]:
+            if word not in (START, STOP):
+                count = self.word_vocab.count(word)
+                if not count or (is_train and np.random.rand() < 1 / (1 + count)):
+                    word = UNK
+            indices.append((self.tag_vocab.index(tag), self.word_vocab.index(word)))
+        return indices
+
+
+    def transduce_batch(self, embeddings, lengths, first_forward=None):
+        '''
+        BiLSTM over a padded minibatch. embeddings[t] is a batched expression holding position t of every
+        sentence, sentences shorter than the longest one are padded at the end. The backward builders read
+        each sentence reversed from its own STOP symbol, so the outputs at the real positions are the same
+        as self.lstm.transduce on the single sentence.
+
+        :param first_forward: outputs of the first forward layer if they are already known
+        '''
+        steps = len(embeddings)
+
+        def reverse(exprs):
+            # Reverses the first length + 2 positions of every batch element, padding stays in place.
+            if all(length + 2 == steps for length in lengths):
+                return list(reversed(exprs))
+            return [
+                dy.concatenate_to_batch([
+                    dy.pick_batch_elem(exprs[length + 1 - t if t <= length + 1 else t], i)
+                    for i, length in enumerate(lengths)])
+                for t in range(steps)]
+
+        def transduce(builder, inputs):
+            state = builder.initial_state()
+            if len(lengths) > 1:
+                # One dropout mask per sentence instead of one for the whole minibatch.
+                builder.set_dropout_masks(len(lengths))
+            return state.transduce(inputs)
+
+        outputs = embeddings
+        for layer, (forward_builder, backward_builder) in enumerate(self.lstm.builder_layers):
+            if layer == 0 and first_forward is not None:
+                forward = first_forward
+            else:
+                forward = transduce(forward_builder, outputs)
+            backward = reverse(transduce(backward_builder, reverse(outputs)))
+            outputs = [dy.concatenate([f, b]) for f, b in zip(forward, backward)]
+        return outputs
+
+
+    def transduce_prefix_cached(self, embeddings, embedding_indices):
+        '''
+        Inference-only BiLSTM that takes the first-layer forward states of the longest cached prefix from
+        self.prefix_cache and runs that builder only over the unseen suffix.
+        '''
+        forward_builder, _ = self.lstm.builder_layers[0]
+        cached_states = self.prefix_cache.lookup(embedding_indices)
+
+        first_forward = [dy.inputVector(h) for c, h in cached_states]
+        if cached_states:
+            c, h = cached_states[-1]
+            state = forward_builder.initial_state([dy.inputVector(c), dy.inputVector(h)])
+        else:
+            state = forward_builder.initial_state()
+
+        new_states = []
+        for embedding in embeddings[len(cached_states):]:
+            state = state.add_input(embedding)
+            first_forward.append(state.output())
+            new_states.append(state.s())
 
+        lstm_outputs = self.transduce_batch(embeddings, [len(embeddings) - 2], first_forward)
+        self.prefix_cache.insert(
+            embedding_indices, cached_states + [(c.npvalue(), h.npvalue()) for c, h in new_states])
+        return lstm_outputs
 
-    def parse(self, sentence, gold=None, gold_chunks=None, latentscope=None):
+
+    def embed_batch(self, sentences, is_train):
+        '''
+        :return: the batched embeddings of every position of the minibatch padded with STOP, and the sentence lengths
+        '''
+        lengths = [len(sentence) for sentence in sentences]
+        max_length = max(lengths)
+        stop_index = (self.tag_vocab.index(STOP), self.word_vocab.index(STOP))
+
+        indices = []
+        for sentence in sentences:
+            sentence_indices = self.get_embedding_indices(sentence, is_train)
+            indices.append(sentence_indices + [stop_index] * (max_length - len(sentence)))
+
+        embeddings = []
+        for position in zip(*indices):
+            tag_embedding = dy.lookup_batch(self.tag_embeddings, [tag_index for tag_index, _ in position])
+            word_embedding = dy.lookup_batch(self.word_embeddings, [word_index for _, word_index in position])
+            embeddings.append(dy.concatenate([tag_embedding, word_embedding]))
+        return embeddings, lengths
+
+
+    def get_non_empty_span_scores(self, lstm_outputs, length):
+        '''
+        :return: (labels - 1) x spans scores of the non-empty labels, the spans ordered as in chart.get_spans(length)
+        '''
+        select_forward, select_backward = get_span_selectors(length)
+        outputs = dy.concatenate_cols(lstm_outputs)
+        forward = dy.pick_range(outputs, 0, self.lstm_dim) * dy.inputTensor(select_forward)
+        backward = dy.pick_range(outputs, self.lstm_dim, 2 * self.lstm_dim) * dy.inputTensor(select_backward)
+        return self.f_label(dy.concatenate([forward, backward]))
+
+
+    def get_label_scores_batch(self, sentences):
+        '''
+        Scores a minibatch of sentences with batched lookups and LSTM expressions and one span-score tensor
+        for the whole batch.
+
+        :return: the (length + 1) x (length + 1) x labels chart of label scores of every sentence
+        '''
+        self.lstm.disable_dropout()
+
+        embeddings, lengths = self.embed_batch(sentences, False)
+        max_length = max(lengths)
+        non_empty_label_scores = self.get_non_empty_span_scores(self.transduce_batch(embeddings, lengths), max_length)
+
+        span_count = len(get_span_index(max_length))
+        span_scores = non_empty_label_scores.npvalue().reshape(self.label_vocab.size - 1, span_count, len(sentences))
+        span_scores = np.concatenate([np.zeros((1, span_count, len(sentences))), span_scores])
+        return [chart.to_chart(span_scores[:, :, i], length, max_length) for i, length in enumerate(lengths)]
+
+
+    def parse_batch(self, sentences, time_budget=None):
+        '''
+        Parses a minibatch of sentences with get_label_scores_batch and the NumPy chart decoder per sentence.
+
+        :param time_budget: see parse_sentences, it starts before the label scores of the minibatch
+        :return: [(tree, score)] in the order of sentences, the same trees as parse() with decoder="numpy"
+        '''
+        if self.chunk_encoding == 2:
+            return [self.parse(sentence, time_budget=time_budget) for sentence in sentences]
+
+        start_time = time.time()
+        return [
+            self.deadline_decoder.decode(sentence, label_scores, time_budget, start_time)
+            for sentence, label_scores in zip(sentences, self.get_label_scores_batch(sentences))]
+
+
+    def kbest_batch(self, sentences, k):
+        '''
+        :return: for every sentence up to k [(tree, score, chunks)] with distinct trees, best first
+        '''
+        assert self.chunk_encoding != 2
+        label_max_lengths = self.get_label_max_lengths()
+        return [
+            [(tree, score, tree.convert().to_chunks())
+             for tree, score in chart.kbest(
+                 sentence, self.label_vocab, label_scores, k, label_max_lengths,
+                 right_branching_labels=self.right_branching_labels)]
+            for sentence, label_scores in zip(sentences, self.get_label_scores_batch(sentences))]
+
+
+    def segment_batch(self, sentences, max_length=None):
+        '''
+        Chunk-only decoding: semi-Markov segmentation over the label scores instead of the chart.
+
+        :return: [(chunks, score)] in the order of sentences, chunks as in tree.convert().to_chunks()
+        '''
+        assert self.chunk_encoding != 2
+        chunk_label_indices = chart.get_chunk_label_indices(self.label_vocab)
+        label_max_lengths = self.get_label_max_lengths()
+        segmented = []
+        for sentence, label_scores in zip(sentences, self.get_label_scores_batch(sentences)):
+            segments, score = chart.segment(label_scores, chunk_label_indices, max_length, label_max_lengths)
+            segmented.append((chart.segments_to_chunks(sentence, self.label_vocab, segments), score))
+        return segmented
+
+
+    def get_loss(self, sentence, gold, gold_chunks, latentscope, label_scores, get_tree_score):
+        '''
+        Loss-augmented decoding and oracle decoding of one training sentence over the NumPy chart of its label
+        scores; DyNet expressions are only built for the spans of the two trees.
+
+        :param get_tree_score: function from the (left, right, label_index) spans of a tree to the expression
+            of the tree score
+        :return: (tree, loss) as parse(sentence, gold, gold_chunks, latentscope)
+        '''
+        oracle_label_indices = self.get_oracle_label_indices(gold, len(sentence))
+        label_indices, splits, branchings, _ = chart.decode(
+            chart.augment(label_scores, oracle_label_indices), self.get_label_max_lengths())
+        tree, tree_spans = chart.backtrack(sentence, self.label_vocab, label_indices, splits, branchings)
+        cost = sum(
+            1 for left, right, label_index in tree_spans
+            if label_index != oracle_label_indices[left, right])
+
+        if self.nontlabelstyle == 3:
+            label_indices, _ = chart.best_labels(label_scores)
+        else:
+            label_indices = oracle_label_indices
+        lefts, rights = np.indices(label_indices.shape)
+        latent = self.latent_labels[label_indices] & (latentscope[0] <= lefts) & (rights <= latentscope[1])
+        label_indices, splits, branchings, _ = chart.oracle_decode(
+            label_scores, label_indices, gold.oracle_splits, latent)
+        _, oracle_tree_spans = chart.backtrack(sentence, self.label_vocab, label_indices, splits, branchings)
+
+        correct = self.zerocostchunk and gold_chunks == tree.convert().to_chunks()
+        if correct:
+            return tree, dy.zeros(1)
+        return tree, get_tree_score(tree_spans) + cost - get_tree_score(oracle_tree_spans)
+
+
+    def train_batch(self, instances, explicit=True):
+        '''
+        Computes the losses of a training minibatch with the span scores of all its sentences in one forward
+        pass, then decodes every sentence with get_loss.
+
+        :param instances: [(sentence, gold, gold_chunks, latentscope)]
+        :param explicit: pad the minibatch into batched expressions, otherwise build one graph per sentence for
+            DyNet autobatching (--dynet-autobatch 1) to batch
+        :return: [(tree, loss)] in the order of instances
+        '''
+        if self.chunk_encoding == 2:
+            return [self.parse(*instance) for instance in instances]
+
+        self.lstm.set_dropout(self.dropout)
+        sentences = [sentence for sentence, _, _, _ in instances]
+        span_scores = []
+        if explicit:
+            embeddings, lengths = self.embed_batch(sentences, True)
+            max_length = max(lengths)
+            batch_scores = self.get_non_empty_span_scores(self.transduce_batch(embeddings, lengths), max_length)
+            span_scores = [(dy.pick_batch_elem(batch_scores, i), max_length) for i in range(len(sentences))]
+        else:
+            for sentence in sentences:
+                embeddings = [
+                    dy.concatenate([self.tag_embeddings[tag_index], self.word_embeddings[word_index]])
+                    for tag_index, word_index in self.get_embedding_indices(sentence, True)]
+                span_scores.append(
+                    (self.get_non_empty_span_scores(self.lstm.transduce(embeddings), len(sentence)), len(sentence)))
+            # A single forward pass over every sentence of the minibatch, which autobatching runs batched.
+            dy.esum([dy.sum_elems(scores) for scores, _ in span_scores]).forward()
+
+        losses = []
+        for (sentence, gold, gold_chunks, latentscope), (scores, padded_length) in zip(instances, span_scores):
+            values = scores.npvalue().reshape(self.label_vocab.size - 1, -1)
+            label_scores = chart.to_chart(
+                np.concatenate([np.zeros((1, values.shape[1])), values]), len(sentence), padded_length)
+
+            # Non-empty label scores flattened column-major, label_index - 1 + (labels - 1) * span.
+            flat_scores = dy.reshape(scores, ((self.label_vocab.size - 1) * values.shape[1],))
+            span_index = get_span_index(padded_length)
+
+            def get_tree_score(tree_spans):
+                return dy.sum_elems(dy.select_rows(flat_scores, [
+                    label_index - 1 + (self.label_vocab.size - 1) * span_index[left, right]
+                    for left, right, label_index in tree_spans if label_index != 0]))
+
+            losses.append(self.get_loss(sentence, gold, gold_chunks, latentscope, label_scores, get_tree_score))
+        return losses
+
+
+    def parse(self, sentence, gold=None, gold_chunks=None, latentscope=None, time_budget=None):
         is_train = gold is not None
+        deadline = None if time_budget is None or is_train else time.time() + time_budget
 
         if is_train:
             self.lstm.set_dropout(self.dropout)
         else:
             self.lstm.disable_dropout()
 
+        embedding_indices = self.get_embedding_indices(sentence, is_train)
         embeddings = []
-        for tag, word in [(START, START)] + sentence + [(STOP, STOP)]:
-            tag_embedding = self.tag_embeddings[self.tag_vocab.index(tag)]
-            if word not in (START, STOP):
-                count = self.word_vocab.count(word)
-                if not count or (is_train and np.random.rand() < 1 / (1 + count)):
-                    word = UNK
-            word_embedding = self.word_embeddings[self.word_vocab.index(word)]
+        for tag_index, word_index in embedding_indices:
+            tag_embedding = self.tag_embeddings[tag_index]
+            word_embedding = self.word_embeddings[word_index]
             embeddings.append(dy.concatenate([tag_embedding, word_embedding]))
 
-        lstm_outputs = self.lstm.transduce(embeddings)
+        if self.prefix_cache is not None and not is_train:
+            lstm_outputs = self.transduce_prefix_cached(embeddings, embedding_indices)
+        else:
+            lstm_outputs = self.lstm.transduce(embeddings)
 
         W_comp = dy.parameter(self.pW_comp)
         b_comp = dy.parameter(self.pb_comp)
@@ -185,21 +540,56 @@ class ChartDynamicRBTConstraintParser(object):
 
             return chunk_rep
 
+        def get_span_scores():
+            # All spans at once: one (labels x spans) matrix with the spans
+            # ordered as in chart.get_spans, so a sentence is scored by a single
+            # pass of f_label instead of one small graph per span.
+            spans = chart.get_spans(len(sentence))
+            if self.chunk_encoding == 2:
+                non_empty_label_scores = self.f_label(dy.concatenate_cols(
+                    [get_span_encoding_chunk(left, right) for left, right in spans]))
+            else:
+                non_empty_label_scores = self.get_non_empty_span_scores(lstm_outputs, len(sentence))
+            return dy.concatenate([dy.zeros((1, len(spans))), non_empty_label_scores])
+
+        right_branching_labels = self.right_branching_labels
+
+        # Bounded chunk lengths are only searched by the NumPy decoder.
+        numpy_decoder = self.decoder == "numpy" or bool(self.chunk_length_limits)
+        use_span_scores = self.span_batch or numpy_decoder
+        if use_span_scores:
+            span_scores = get_span_scores()
+            span_index = get_span_index(len(sentence))
+
         @functools.lru_cache(maxsize=None)
         def get_label_scores(left, right):
+            if use_span_scores:
+                return dy.pick(span_scores, span_index[left, right], 1)
             non_empty_label_scores = self.f_label(get_span_encoding(left, right))
             return dy.concatenate([dy.zeros(1), non_empty_label_scores])
 
 
+        def decode_numpy(label_scores):
+            label_indices, splits, branchings, score = chart.decode(
+                label_scores, self.get_label_max_lengths(), right_branching_labels, deadline)
+            tree, _ = chart.backtrack(sentence, self.label_vocab, label_indices, splits, branchings)
+            return tree, score
 
         def helper(force_gold):
             if force_gold:
                 assert is_train
 
-            chart = {}
-            label_scores_span_max = {}
+            # Only scores and backpointers are kept per span; the tree is
+            # built once by chart.backtrack.
+            chart_scores = {}
+            span_label_scores = {}
+            label_indices = {}
+            splits = {}
+            branchings = {}
 
             for length in range(1, len(sentence) + 1):
+                if deadline is not None and not force_gold and time.time() > deadline:
+                    raise chart.DeadlineExceeded()
                 for left in range(0, len(sentence) + 1 - length):
                     right = left + length
 
@@ -212,18 +602,13 @@ class ChartDynamicRBTConstraintParser(object):
 
 
                     if force_gold:
-                        label = oracle_label
                         label_index = oracle_label_index
-                        label_score = label_scores[label_index]
 
                         if self.nontlabelstyle == 3:
                             label_scores_np = label_scores.npvalue()
-                            argmax_label_index = int(
+                            label_index = int(
                                 label_scores_np.argmax() if length < len(sentence) else
                                 label_scores_np[1:].argmax() + 1)
-                            argmax_label = self.label_vocab.value(argmax_label_index)
-                            label = argmax_label
-                            label_score = label_scores[argmax_label_index]
 
                     else:
                         if is_train:
@@ -231,20 +616,17 @@ class ChartDynamicRBTConstraintParser(object):
                         label_scores_np = label_scores.npvalue()
                         #argmax_score = dy.argmax(label_scores, gradient_mode="straight_through_gradient")
                         #dy.dot_product()
-                        argmax_label_index = int(
+                        label_index = int(
                             label_scores_np.argmax() if length < len(sentence) else
                             label_scores_np[1:].argmax() + 1)
-                        argmax_label = self.label_vocab.value(argmax_label_index)
-                        label = argmax_label
-                        label_score = label_scores[argmax_label_index]
+
+                    label = self.label_vocab.value(label_index)
+                    label_score = label_scores[label_index]
+                    label_indices[left, right] = label_index
+                    span_label_scores[left, right] = label_score
 
                     if length == 1:
-                        tag, word = sentence[left]
-                        tree = trees.LeafParseNode(left, tag, word)
-                        if label:
-                            tree = trees.InternalParseNode(label, [tree])
-                        chart[left, right] = [tree], label_score
-                        label_scores_span_max[left, right] = [tree], label_score
+                        chart_scores[left, right] = label_score
                         continue
 
                     if force_gold:
@@ -263,8 +645,8 @@ class ChartDynamicRBTConstraintParser(object):
                             oracle_splits = [(oracle_splits[0], 0), (oracle_splits[-1], 1)]
                             best_split = max(oracle_splits,
                                              key=lambda sb : #(split, branching)  #branching == 0: right branching;  1: left branching
-                                             label_scores_span_max[left, sb[0]][1].value() + chart[sb[0], right][1].value() if sb[1] == 0 else
-                                             chart[left, sb[0]][1].value() + label_scores_span_max[sb[0], right][1].value()
+                                             span_label_scores[left, sb[0]].value() + chart_scores[sb[0], right].value() if sb[1] == 0 else
+                                             chart_scores[left, sb[0]].value() + span_label_scores[sb[0], right].value()
                                              )
                         else:
 
@@ -273,43 +655,55 @@ class ChartDynamicRBTConstraintParser(object):
 
                     else:
                         pred_range = range(left + 1, right)
-                        pred_splits = [(p, 0) for p in pred_range] + [(p, 1) for p in pred_range]
+                        pred_splits = [(p, 0) for p in pred_range]
+                        if is_train or right_branching_labels is None or not right_branching_labels[label_index]:
+                            pred_splits += [(p, 1) for p in pred_range]
                         best_split = max(pred_splits,
                                          key=lambda sb:  # (split, branching)  #branching == 0: right branching;  1: left branching
-                                         label_scores_span_max[left, sb[0]][1].value() + chart[sb[0], right][1].value() if sb[1] == 0 else
-                                         chart[left, sb[0]][1].value() + label_scores_span_max[sb[0], right][1].value()
+                                         span_label_scores[left, sb[0]].value() + chart_scores[sb[0], right].value() if sb[1] == 0 else
+                                         chart_scores[left, sb[0]].value() + span_label_scores[sb[0], right].value()
                                          )
 
-                    children_leaf = [trees.LeafParseNode(pos, sentence[pos][0], sentence[pos][1]) for pos in range(left, right)]
-                    label_scores_span_max[left, right] = children_leaf, label_score
-
-
+                    splits[left, right], branchings[left, right] = best_split
 
                     if best_split[1] == 0:#Right Branching
-                        left_trees, left_score = label_scores_span_max[left, best_split[0]]
-                        right_trees, right_score = chart[best_split[0], right]
+                        left_score = span_label_scores[left, best_split[0]]
+                        right_score = chart_scores[best_split[0], right]
                     else:#Left Branching
-                        left_trees, left_score = chart[left, best_split[0]]
-                        right_trees, right_score = label_scores_span_max[best_split[0], right]
+                        left_score = chart_scores[left, best_split[0]]
+                        right_score = span_label_scores[best_split[0], right]
 
+                    chart_scores[left, right] = label_score + left_score + right_score
 
-                    children = left_trees + right_trees
 
-                    if label:
-                        children = [trees.InternalParseNode(label, children)]
-                        if not label[0].endswith("'"):
-                            children_leaf = [trees.InternalParseNode(label, children_leaf)]
-                            label_scores_span_max[left, right] = children_leaf, label_score
 
-                    chart[left, right] = (children, label_score + left_score + right_score)
+            tree, _ = chart.backtrack(sentence, self.label_vocab, label_indices, splits, branchings)
+            return tree, chart_scores[0, len(sentence)]
 
+        def decode_fallback():
+            scores = span_scores if use_span_scores else get_span_scores()
+            label_scores = chart.to_chart(scores.npvalue().reshape(self.label_vocab.size, -1), len(sentence))
+            self.deadline_decoder.timeout_fallbacks += 1
+            return self.deadline_decoder.fallback(sentence, label_scores)
 
+        if numpy_decoder:
+            # One .npvalue() for the whole sentence, shared by the predicted
+            # and the oracle pass when training.
+            label_scores = chart.to_chart(
+                span_scores.npvalue().reshape(self.label_vocab.size, -1), len(sentence))
+            if is_train:
+                return self.get_loss(
+                    sentence, gold, gold_chunks, latentscope, label_scores,
+                    lambda tree_spans: dy.esum([
+                        get_label_scores(left, right)[label_index] for left, right, label_index in tree_spans]))
 
-            children, score = chart[0, len(sentence)]
-            assert len(children) == 1
-            return children[0], score
-
-        tree, score = helper(False)
+        try:
+            if numpy_decoder:
+                tree, score = decode_numpy(label_scores)
+            else:
+                tree, score = helper(False)
+        except chart.DeadlineExceeded:
+            tree, score = decode_fallback()
         if is_train:
             oracle_tree, oracle_score = helper(True)
             #assert oracle_tree.convert().linearize() == gold.convert().linearize()
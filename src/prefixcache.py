@@ -0,0 +1,84 @@
+import collections
+
+
+class PrefixNode(object):
+    def __init__(self, parent, key, state):
+        self.parent = parent
+        self.key = key
+        self.state = state
+        self.children = {}
+
+
+class PrefixStateCache(object):
+    '''
+    Trie of first-layer forward LSTM states keyed by embedding index prefixes (START included).
+
+    Only the first forward layer is cached: it is the only layer of the stacked BiLSTM whose states depend on
+    the prefix alone, every later layer reads the backward states of the layer below.
+    Nodes are evicted least recently used; a lookup touches the deepest node first and the root side last, so
+    the least recently used node is always a leaf.
+    '''
+
+    def __init__(self, max_states=100000):
+        self.max_states = max_states
+        self.root = PrefixNode(None, None, None)
+        self.recency = collections.OrderedDict()
+        self.lookups = 0
+        self.tokens = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+        self.hit_lengths = collections.Counter()
+
+    def __len__(self):
+        return len(self.recency)
+
+    def touch(self, path):
+        for node in reversed(path):
+            self.recency[id(node)] = node
+            self.recency.move_to_end(id(node))
+
+    def lookup(self, keys):
+        '''
+        :return: states of the longest cached prefix of keys, one (c, h) pair per position
+        '''
+        node = self.root
+        path = []
+        for key in keys:
+            node = node.children.get(key)
+            if node is None:
+                break
+            path.append(node)
+        self.touch(path)
+
+        self.lookups += 1
+        self.tokens += len(keys)
+        self.hit_tokens += len(path)
+        self.hit_lengths[len(path)] += 1
+        return [node.state for node in path]
+
+    def insert(self, keys, states):
+        '''
+        :param states: (c, h) numpy vectors after each position of keys
+        '''
+        node = self.root
+        path = []
+        for key, state in zip(keys, states):
+            child = node.children.get(key)
+            if child is None:
+                child = PrefixNode(node, key, state)
+                node.children[key] = child
+            node = child
+            path.append(node)
+        self.touch(path)
+
+        while len(self.recency) > self.max_states:
+            _, node = self.recency.popitem(last=False)
+            del node.parent.children[node.key]
+            self.evictions += 1
+
+    def report(self):
+        return "prefix-cache states {:,} lookups {:,} hit-tokens {:,}/{:,} ({:.1f}%) mean-hit-length {:.2f} evictions {:,}".format(
+            len(self.recency), self.lookups, self.hit_tokens, self.tokens,
+            100.0 * self.hit_tokens / self.tokens if self.tokens else 0.0,
+            self.hit_tokens / self.lookups if self.lookups else 0.0,
+            self.evictions)
@@ -0,0 +1,96 @@
+import collections
+import itertools
+import multiprocessing
+import threading
+
+
+def worker_loop(parse_tokens, connection):
+    while True:
+        try:
+            token_lists = connection.recv()
+        except EOFError:
+            break
+        if token_lists is None:
+            break
+        try:
+            connection.send((True, parse_tokens(token_lists)))
+        except Exception as e:
+            connection.send((False, repr(e)))
+
+
+class ForkedWorkerPool(object):
+    '''
+    Parses in N forked worker processes that share the parent's loaded model.
+
+    DyNet has one computation graph per process, so each worker parses one batch at a time. The model is
+    loaded once before forking and the workers read the DyNet parameter memory copy-on-write: it is never
+    written during inference, so it is not duplicated in their resident memory.
+    parse_tokens is thread safe: each call sends a batch to one worker, chosen round-robin or as the worker
+    with the fewest outstanding batches, and blocks until that worker answers.
+    '''
+
+    def __init__(self, parse_tokens, workers, dispatch="least-loaded"):
+        assert dispatch in ("least-loaded", "round-robin")
+        self.dispatch = dispatch
+        self.lock = threading.Lock()
+        self.round_robin = itertools.cycle(range(workers))
+        self.outstanding = [0] * workers
+        self.handled = [0] * workers
+        self.connections = []
+        self.connection_locks = []
+        self.processes = []
+
+        context = multiprocessing.get_context("fork")
+        for _ in range(workers):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=worker_loop, args=(parse_tokens, child_connection), daemon=True)
+            process.start()
+            child_connection.close()
+            self.connections.append(parent_connection)
+            self.connection_locks.append(threading.Lock())
+            self.processes.append(process)
+
+    @property
+    def size(self):
+        return len(self.processes)
+
+    def choose_worker(self):
+        with self.lock:
+            if self.dispatch == "round-robin":
+                worker = next(self.round_robin)
+            else:
+                worker = min(range(self.size), key=lambda i: self.outstanding[i])
+            self.outstanding[worker] += 1
+        return worker
+
+    def parse_tokens(self, token_lists):
+        worker = self.choose_worker()
+        try:
+            with self.connection_locks[worker]:
+                self.connections[worker].send(token_lists)
+                ok, result = self.connections[worker].recv()
+        finally:
+            with self.lock:
+                self.outstanding[worker] -= 1
+                self.handled[worker] += 1
+        if not ok:
+            raise RuntimeError("worker {} failed: {}".format(worker, result))
+        return result
+
+    def metrics(self):
+        return collections.OrderedDict([
+            ("workers", self.size),
+            ("dispatch", self.dispatch),
+            ("outstanding", list(self.outstanding)),
+            ("handled", list(self.handled)),
+            ("alive", [process.is_alive() for process in self.processes]),
+        ])
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join(timeout=1)
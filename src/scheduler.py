@@ -0,0 +1,116 @@
+import bisect
+import collections
+import time
+
+
+class BucketStats(object):
+    def __init__(self):
+        self.sentences = 0
+        self.batches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.seconds = 0.0
+
+    def sentences_per_second(self):
+        return self.sentences / self.seconds if self.seconds > 0 else 0.0
+
+    def tokens_per_second(self):
+        return self.tokens / self.seconds if self.seconds > 0 else 0.0
+
+    def padding_ratio(self):
+        return 1 - self.tokens / self.padded_tokens if self.padded_tokens > 0 else 0.0
+
+    def __str__(self):
+        return "sentences {:,} batches {:,} sents/sec {:.1f} tokens/sec {:.1f} padding {:.1f}%".format(
+            self.sentences, self.batches, self.sentences_per_second(), self.tokens_per_second(),
+            self.padding_ratio() * 100)
+
+
+class BucketScheduler(object):
+    '''
+    Groups sentences of similar length into batches for a batched parse function and puts the results back
+    in input order.
+
+    A batch padded to length n costs batch_size * n tokens and batch_size * n * (n + 1) / 2 chart cells;
+    batches are filled in length order until either budget (or max_batch_size) would be exceeded. A single
+    sentence over budget still forms its own batch.
+    '''
+
+    def __init__(self, parse_batch, bucket_bounds=(8, 16, 24, 32, 48, 64, 96, 128),
+                 max_batch_tokens=2048, max_batch_cells=None, max_batch_size=64):
+        '''
+        :param parse_batch: function from a list of sentences to a list of results, e.g. parser.parse_batch
+        :param bucket_bounds: inclusive upper length of each bucket, longer sentences share one last bucket
+        '''
+        self.parse_batch = parse_batch
+        self.bucket_bounds = sorted(bucket_bounds)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_cells = max_batch_cells
+        self.max_batch_size = max_batch_size
+        self.stats = collections.OrderedDict((bucket, BucketStats()) for bucket in self.bucket_names())
+
+    def bucket_names(self):
+        names = []
+        lower = 1
+        for bound in self.bucket_bounds:
+            names.append("{}-{}".format(lower, bound))
+            lower = bound + 1
+        names.append("{}+".format(lower))
+        return names
+
+    def bucket_of(self, length):
+        return bisect.bisect_left(self.bucket_bounds, length)
+
+    def fits(self, batch_size, padded_length):
+        if batch_size > self.max_batch_size:
+            return False
+        if self.max_batch_tokens is not None and batch_size * padded_length > self.max_batch_tokens:
+            return False
+        if self.max_batch_cells is not None and batch_size * padded_length * (padded_length + 1) // 2 > self.max_batch_cells:
+            return False
+        return True
+
+    def batches(self, sentences):
+        '''
+        :return: list of (bucket index, [sentence indices]) covering every sentence exactly once
+        '''
+        buckets = collections.defaultdict(list)
+        for index, sentence in enumerate(sentences):
+            buckets[self.bucket_of(len(sentence))].append(index)
+
+        batches = []
+        for bucket in sorted(buckets):
+            indices = sorted(buckets[bucket], key=lambda index: len(sentences[index]))
+            batch = []
+            for index in indices:
+                # Sorted by length, so the new sentence sets the padded length of the batch.
+                if batch and not self.fits(len(batch) + 1, len(sentences[index])):
+                    batches.append((bucket, batch))
+                    batch = []
+                batch.append(index)
+            if batch:
+                batches.append((bucket, batch))
+        return batches
+
+    def parse(self, sentences):
+        results = [None] * len(sentences)
+        names = list(self.stats)
+        for bucket, batch in self.batches(sentences):
+            start_time = time.time()
+            batch_results = self.parse_batch([sentences[index] for index in batch])
+            elapsed = time.time() - start_time
+
+            for index, result in zip(batch, batch_results):
+                results[index] = result
+
+            stats = self.stats[names[bucket]]
+            stats.sentences += len(batch)
+            stats.batches += 1
+            stats.tokens += sum(len(sentences[index]) for index in batch)
+            stats.padded_tokens += len(batch) * max(len(sentences[index]) for index in batch)
+            stats.seconds += elapsed
+        return results
+
+    def report(self):
+        return "\n".join(
+            "bucket {} {}".format(name, stats) for name, stats in self.stats.items() if stats.batches > 0)
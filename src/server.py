@@ -0,0 +1,236 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+
+import stream
+import util
+
+
+class LatencyHistogram(object):
+    bounds_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds_ms) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000
+        index = 0
+        while index < len(self.bounds_ms) and ms > self.bounds_ms[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def to_dict(self):
+        buckets = collections.OrderedDict(
+            ("le_{}ms".format(bound), count) for bound, count in zip(self.bounds_ms, self.counts))
+        buckets["le_inf"] = self.counts[-1]
+        return collections.OrderedDict([
+            ("count", self.count),
+            ("mean_ms", self.total / self.count if self.count else 0.0),
+            ("max_ms", self.max),
+            ("buckets", buckets),
+        ])
+
+
+class MicroBatcher(object):
+    '''
+    Coalesces concurrent parse requests: the first queued request waits at most max_wait seconds for others
+    to join its batch, then the batch is parsed with one call of parse_tokens on a single worker thread
+    (DyNet has one computation graph per process).
+    With max_inflight > 1 up to that many batches are parsed at once, for a parse_tokens that hands batches to
+    worker processes (prefork.ForkedWorkerPool); a new batch is only formed once a slot is free, so requests
+    keep coalescing while every worker is busy.
+    '''
+
+    def __init__(self, parse_tokens, max_batch_size=32, max_wait=0.005, executor=None, max_inflight=1):
+        '''
+        :param parse_tokens: blocking function from a list of token lists to [(tree, chunks)]
+        :param executor: where parse_tokens runs, a thread pool of max_inflight threads by default
+        '''
+        self.parse_tokens = parse_tokens
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_inflight = max_inflight
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=max_inflight)
+        self.queue = None
+        self.max_queue_depth = 0
+        self.batches = 0
+        self.batch_sizes = collections.Counter()
+        self.queue_latency = LatencyHistogram()
+        self.parse_latency = LatencyHistogram()
+
+    async def submit(self, tokens):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tokens, future, time.time()))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def run(self):
+        self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_inflight)
+        while True:
+            await slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            asyncio.ensure_future(self.run_batch(batch, slots))
+
+    async def run_batch(self, batch, slots):
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        for _, _, queued_time in batch:
+            self.queue_latency.observe(start_time - queued_time)
+        try:
+            results = await loop.run_in_executor(
+                self.executor, self.parse_tokens, [tokens for tokens, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            slots.release()
+        self.parse_latency.observe(time.time() - start_time)
+        self.batches += 1
+        self.batch_sizes[len(batch)] += 1
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def metrics(self):
+        return collections.OrderedDict([
+            ("queue_depth", self.queue.qsize() if self.queue is not None else 0),
+            ("max_queue_depth", self.max_queue_depth),
+            ("batches", self.batches),
+            ("batch_sizes", collections.OrderedDict(sorted(self.batch_sizes.items()))),
+            ("queue_latency", self.queue_latency.to_dict()),
+            ("parse_latency", self.parse_latency.to_dict()),
+        ])
+
+
+class ParseServer(object):
+    '''
+    Minimal HTTP/1.1 JSON server:
+        POST /parse    {"address": "..."} or {"addresses": ["...", ...]}
+        GET  /metrics  queue depth, batch sizes and latency histograms
+        GET  /health
+    '''
+
+    def __init__(self, batcher, host="127.0.0.1", port=8080, worker_pool=None):
+        self.batcher = batcher
+        self.worker_pool = worker_pool
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self.degraded = 0
+        self.request_latency = LatencyHistogram()
+
+    async def parse_address(self, text):
+        tokens = util.tokenize_address(text)
+        if not tokens:
+            return stream.to_record(text, None, [])
+        tree, chunks = await self.batcher.submit(tokens)
+        if tree.degraded:
+            self.degraded += 1
+        return stream.to_record(text, tree, chunks)
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        if method == "GET" and path == "/metrics":
+            metrics = collections.OrderedDict([
+                ("requests", self.requests),
+                ("errors", self.errors),
+                ("degraded", self.degraded),
+                ("request_latency", self.request_latency.to_dict()),
+            ])
+            metrics.update(self.batcher.metrics())
+            if self.worker_pool is not None:
+                metrics["worker_pool"] = self.worker_pool.metrics()
+            return 200, metrics
+        if method == "POST" and path == "/parse":
+            request = json.loads(body.decode("utf-8"))
+            if "addresses" in request:
+                results = await asyncio.gather(*[self.parse_address(text) for text in request["addresses"]])
+                return 200, {"results": results}
+            return 200, await self.parse_address(request["address"])
+        return 404, {"error": "not found"}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode("latin-1").split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                start_time = time.time()
+                self.requests += 1
+                try:
+                    status, response = await self.route(method, path, body)
+                except (ValueError, KeyError, TypeError) as e:
+                    status, response = 400, {"error": str(e)}
+                except Exception as e:
+                    status, response = 500, {"error": str(e)}
+                if status >= 400:
+                    self.errors += 1
+                self.request_latency.observe(time.time() - start_time)
+
+                payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                close = headers.get("connection", "").lower() == "close"
+                writer.write(
+                    "HTTP/1.1 {} {}\r\n"
+                    "Content-Type: application/json; charset=utf-8\r\n"
+                    "Content-Length: {}\r\n"
+                    "Connection: {}\r\n\r\n".format(
+                        status, {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(status, "Error"),
+                        len(payload), "close" if close else "keep-alive").encode("latin-1") + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, ready=None):
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        print("Serving on http://{}:{}/".format(self.host, self.port), flush=True)
+        if ready is not None:
+            ready()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+    def run(self):
+        asyncio.run(self.serve())
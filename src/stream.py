@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+
+import evaluate
+import util
+
+
+def read_addresses(paths, skip=0):
+    '''
+    Yields (line_number, text) for every line of the files in paths (stdin if paths is empty), 1-based over
+    all inputs, skipping the first skip lines.
+    '''
+    line_number = 0
+    for path in paths or ['-']:
+        f = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+        try:
+            for line in f:
+                line_number += 1
+                if line_number <= skip:
+                    continue
+                yield line_number, line.strip()
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def to_record(text, tree, chunks):
+    '''
+    :param chunks: (label, start, end, tokens) over the tokens of util.tokenize_address(text)
+    :return: the output record, its chunk start and end are character offsets in text, end excluded
+    '''
+    offsets = util.get_token_offsets(text)
+    return {
+        "address": text,
+        "chunks": [
+            {"label": label, "start": offsets[s][0], "end": offsets[e - 1][1], "text": ''.join(chunk_text)}
+            for label, s, e, chunk_text in chunks],
+        "tree": tree.linearize() if tree is not None else None,
+        "degraded": tree is not None and tree.degraded,
+    }
+
+
+def format_jsonl(line_number, text, tree, chunks):
+    record = {"line": line_number}
+    record.update(to_record(text, tree, chunks))
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def format_bio(line_number, text, tree, chunks):
+    seq = evaluate.chunk2seq(chunks)
+    return ''.join("{}\t{}\n".format(token, tag) for token, tag in zip(evaluate.get_text_from_chunks(chunks), seq)) + '\n'
+
+
+formatters = {"jsonl": format_jsonl, "bio": format_bio}
+
+
+class Progress(object):
+    '''
+    Number of input lines whose output has been written, kept in a small file so an interrupted run can resume.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return int(f.read().strip() or 0)
+
+    def save(self, lines_done):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("{}\n".format(lines_done))
+        os.replace(tmp_path, self.path)
+
+
+def parse_stream(addresses, parse_tokens, buffer_size):
+    '''
+    Tokenises and parses (line_number, text) pairs buffer_size lines at a time.
+
+    :param parse_tokens: function from a list of token lists to [(tree, chunks)]
+    :return: generator of (line_number, text, tree, chunks); empty lines give (line_number, '', None, [])
+    '''
+    for buffer in batched(addresses, buffer_size):
+        tokenized = [(line_number, text, util.tokenize_address(text)) for line_number, text in buffer]
+        parsed = iter(parse_tokens([tokens for _, _, tokens in tokenized if tokens]))
+        for line_number, text, tokens in tokenized:
+            tree, chunks = next(parsed) if tokens else (None, [])
+            yield line_number, text, tree, chunks
@@ -1,9 +1,9 @@
 import collections.abc
-import parse
 import util
 
 class TreebankNode(object):
-    pass
+    # True on the root of a tree built by the fallback decoder (chart.fallback_parse) instead of the chart.
+    degraded = False
 
 class InternalTreebankNode(TreebankNode):
     def __init__(self, label, children):
@@ -177,7 +177,7 @@ class InternalUncompletedTreebankNode(TreebankNode):
 
 
 class ParseNode(object):
-    pass
+    degraded = False
 
 class InternalParseNode(ParseNode):
     def __init__(self, label, children):
@@ -207,6 +207,8 @@ class InternalParseNode(ParseNode):
         tree = InternalTreebankNode(self.label[-1], children)
         for sublabel in reversed(self.label[:-1]):
             tree = InternalTreebankNode(sublabel, [tree])
+        if self.degraded:
+            tree.degraded = True
         return tree
 
     def enclosing(self, left, right):
@@ -250,6 +252,14 @@ class InternalParseNode(ParseNode):
         #     ]
 
 
+    def oracle_spans(self):
+        '''
+        :return: the spans whose oracle_label may be non-empty, every other span has the empty label
+        '''
+        yield self.left, self.right
+        for child in self.children:
+            yield from child.oracle_spans()
+
     def oracle_splits2(self, left, right):
         # return [
         #     child.left
@@ -430,6 +440,14 @@ class InternalUncompletedParseNode(InternalParseNode):
 
         return ret
 
+    def oracle_spans(self):
+        # Any two chunk boundaries of the latent region may bound a span of the latent tree.
+        for i, left in enumerate(self.splits):
+            for right in self.splits[i + 1:]:
+                yield left, right
+        for chunkleaf in self.chunkleaves:
+            yield from chunkleaf.oracle_spans()
+
 
 
 class LeafParseNode(ParseNode):
@@ -448,6 +466,9 @@ class LeafParseNode(ParseNode):
     def leaves(self):
         yield self
 
+    def oracle_spans(self):
+        return iter(())
+
     def convert(self):
         return LeafTreebankNode(self.tag, self.word)
 
@@ -1,3 +1,5 @@
+import re
+
 import vocabulary
 
 
@@ -17,6 +19,39 @@ def is_digit(tok:str):
     return False
 
 
+def normalize_word(word):
+    newword = ''
+    for c in word:
+        if is_digit(c):
+            newword += '0'
+        else:
+            newword += c
+    return newword
+
+
+# Runs of digits and runs of latin letters (ASCII or full width) are mostly one token in data/*.txt, every
+# other character, dashes included, is a token on its own.
+address_token_pattern = re.compile(r'[0-9\uff10-\uff19]+|[A-Za-z\uff21-\uff3a\uff41-\uff5a]+|\S')
+
+def tokenize_address(text):
+    return address_token_pattern.findall(text)
+
+
+def get_token_offsets(text):
+    '''
+    :return: the (start, end) character offsets in text of the tokens of tokenize_address
+    '''
+    return [match.span() for match in address_token_pattern.finditer(text)]
+
+
+def get_tokenize_mismatches(insts):
+    '''
+    :param insts: (x, chunks) as read_chunks with normal 0
+    :return: the token lists x that tokenize_address does not give back from their text
+    '''
+    return [x for x, _ in insts if tokenize_address(''.join(x)) != list(x)]
+
+
 def seq2chunk(seq):
     chunks = []
     label = None
@@ -59,12 +94,7 @@ def read_chunks(filename, normal = 1):
                 new_x = []
                 for word in x:
                     if normal == 1:
-                        newword = ''
-                        for c in word:
-                            if is_digit(c):
-                                newword += '0'
-                            else:
-                                newword += c
+                        newword = normalize_word(word)
                     else:
                         newword = word
 
@@ -92,6 +122,19 @@ def read_chunks(filename, normal = 1):
     return insts
 
 
+def get_chunk_length_limits(insts, maxllimit=None):
+    '''
+    :return: {label: length of the longest chunk with that label}, over the instances kept for training
+    '''
+    limits = {}
+    for x, chunks in insts:
+        if maxllimit is not None and any(e - s > maxllimit for label, s, e in chunks):
+            continue
+        for label, s, e in chunks:
+            limits[label] = max(limits.get(label, 0), e - s)
+    return limits
+
+
 def load_trees_from_str(tokens, normal = 1, strip_top=True):
     from trees import InternalTreebankNode, LeafTreebankNode
 